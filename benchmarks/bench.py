@@ -0,0 +1,363 @@
+# bench.py - load-testing and benchmark suite for webchef.py
+#
+# Builds a synthetic web root, starts a server on it and drives it with a
+# concurrent client built from the standard library only. Every
+# (target, scenario, concurrency) run gets a fresh server so the peak RSS
+# belongs to that run alone. Results can be saved as a JSON baseline, and
+# later runs are compared against it; regressions make the run fail.
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, 'benchmarks', 'baseline.json')
+
+V1_SCRIPT = os.path.join(REPO_ROOT, 'webchef-v1', 'webchef.py')
+V2_SCRIPT = os.path.join(REPO_ROOT, 'webchef-v2', 'webchef.py')
+
+# How each server is started. v1 has its port and root baked in, so it always
+# serves the current directory on port 8000; it is run through a small wrapper
+# that lets it rebind the port while the previous run's sockets sit in TIME_WAIT.
+# Scenarios a target cannot serve at all are skipped for it: v1 answers a
+# directory without index.html with a 404, so it has no huge-directory listing.
+TARGETS = {
+    'v2': {'port': 8080,
+           'command': lambda port: [V2_SCRIPT, '--port', str(port)],
+           'skip': set()},
+    'v1': {'port': 8000,
+           'command': lambda port: ['-c', 'import runpy, socketserver; '
+                                          'socketserver.TCPServer.allow_reuse_address = True; '
+                                          f'runpy.run_path({V1_SCRIPT!r}, run_name="__main__")'],
+           'skip': {'huge-directory'}},
+}
+
+SCENARIOS = ['small-files', 'large-file', 'deep-tree', 'huge-directory', 'not-found']
+
+# A regression has to be both relatively and absolutely noticeable, so tiny
+# numbers jittering around don't fail the run
+P99_NOISE_FLOOR_MS = 1.0
+RSS_NOISE_FLOOR_MB = 5.0
+ERROR_RATE_FLOOR = 0.01
+
+# --- Synthetic Web Root ---
+def build_web_root(root, scale):
+    """Creates the files every scenario requests and returns their URL paths."""
+    rng = random.Random(1234)
+    words = ['chef', 'kitchen', 'recipe', 'pantry', 'oven', 'menu', 'dish', 'table']
+
+    with open(os.path.join(root, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write('<!DOCTYPE html><title>bench</title><p>webchef benchmark kitchen</p>\n')
+
+    small_dir = os.path.join(root, 'small')
+    os.makedirs(small_dir)
+    small_paths = []
+    for i in range(max(10, int(500 * scale))):
+        name = f'{i:05d}.html'
+        size = rng.randint(1024, 4096)
+        text = ' '.join(rng.choice(words) for _ in range(size // 6))
+        with open(os.path.join(small_dir, name), 'w', encoding='utf-8') as f:
+            f.write(f'<!DOCTYPE html><title>{name}</title><p>{text}</p>\n')
+        small_paths.append(f'/small/{name}')
+
+    large_dir = os.path.join(root, 'large')
+    os.makedirs(large_dir)
+    block = os.urandom(1024 * 1024)
+    large_paths = []
+    for i in range(2):
+        name = f'blob-{i}.bin'
+        with open(os.path.join(large_dir, name), 'wb') as f:
+            for _ in range(max(1, int(32 * scale))):
+                f.write(block)
+        large_paths.append(f'/large/{name}')
+
+    deep_paths = []
+    for branch in range(4):
+        parts = [f'level{depth}-{branch}' for depth in range(16)]
+        deep_dir = os.path.join(root, 'deep', *parts)
+        os.makedirs(deep_dir)
+        with open(os.path.join(deep_dir, 'leaf.html'), 'w', encoding='utf-8') as f:
+            f.write('<p>you made it all the way down</p>\n')
+        deep_paths.append('/deep/' + '/'.join(parts) + '/leaf.html')
+
+    huge_dir = os.path.join(root, 'huge')
+    os.makedirs(huge_dir)
+    for i in range(max(100, int(20000 * scale))):
+        open(os.path.join(huge_dir, f'entry-{i:06d}.txt'), 'wb').close()
+
+    return {
+        'small-files': (small_paths, 200),
+        'large-file': (large_paths, 200),
+        'deep-tree': (deep_paths, 200),
+        'huge-directory': (['/huge/'], 200),
+        'not-found': ([f'/missing/{i}.png' for i in range(50)], 404),
+    }
+
+# --- Server Control ---
+def start_server(target, root, extra_args):
+    """Starts a server process on `root` and waits until it accepts connections."""
+    config = TARGETS[target]
+    command = [sys.executable] + config['command'](config['port']) + extra_args
+    process = subprocess.Popen(command, cwd=root, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{target} server exited right away (code {process.returncode})")
+        try:
+            socket.create_connection(('127.0.0.1', config['port']), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    stop_server(process)
+    raise RuntimeError(f"{target} server did not start listening on port {config['port']}")
+
+def stop_server(process):
+    """Stops a server the way a user would (Ctrl+C), forcing it if needed."""
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT if hasattr(signal, 'SIGINT') and os.name != 'nt'
+                            else signal.SIGTERM)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def peak_rss_mb(process):
+    """Peak resident memory of a running server in MB, or None if unknown."""
+    try:
+        with open(f'/proc/{process.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+# --- Load Generation ---
+def client_thread(port, paths, expected_status, deadline, seed, results):
+    """Sends requests over one keep-alive connection until `deadline`."""
+    rng = random.Random(seed)
+    buffer = bytearray(256 * 1024)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    latencies = []
+    received = 0
+    errors = 0
+    while time.perf_counter() < deadline:
+        path = rng.choice(paths)
+        started = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            while True:
+                read = response.readinto(buffer)
+                if not read:
+                    break
+                received += read
+            if response.status != expected_status:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+    results.append((latencies, received, errors))
+
+def client_process(port, paths, expected_status, threads, duration, seed):
+    """Runs `threads` client threads in this process and merges their results."""
+    results = []
+    deadline = time.perf_counter() + duration
+    workers = [threading.Thread(target=client_thread,
+                                args=(port, paths, expected_status, deadline, seed + i, results))
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    latencies, received, errors = [], 0, 0
+    for thread_latencies, thread_received, thread_errors in results:
+        latencies.extend(thread_latencies)
+        received += thread_received
+        errors += thread_errors
+    return latencies, received, errors
+
+def run_load(port, paths, expected_status, concurrency, duration):
+    """
+    Drives the server with `concurrency` connections for `duration` seconds.
+    Connections are spread over several processes so the client's own GIL
+    does not become the bottleneck.
+    """
+    processes = max(1, min(concurrency, os.cpu_count() or 1))
+    per_process = [concurrency // processes + (1 if i < concurrency % processes else 0)
+                   for i in range(processes)]
+    started = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(client_process, port, paths, expected_status, threads,
+                               duration, 1000 * i)
+                   for i, threads in enumerate(per_process)]
+        outcomes = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    latencies, received, errors = [], 0, 0
+    for process_latencies, process_received, process_errors in outcomes:
+        latencies.extend(process_latencies)
+        received += process_received
+        errors += process_errors
+    latencies.sort()
+
+    def percentile(q):
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'mb_per_s': received / elapsed / (1024 * 1024),
+        'errors': errors,
+    }
+
+# --- Baseline Comparison ---
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns a list of human-readable regressions against `baseline`."""
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {result['rps']:.0f} req/s, "
+                               f"baseline {base['rps']:.0f} req/s")
+        if (result['p99_ms'] > base['p99_ms'] * (1 + tolerance)
+                and result['p99_ms'] - base['p99_ms'] > P99_NOISE_FLOOR_MS):
+            regressions.append(f"{key}: p99 latency {result['p99_ms']:.1f} ms, "
+                               f"baseline {base['p99_ms']:.1f} ms")
+        if (result.get('peak_rss_mb') and base.get('peak_rss_mb')
+                and result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance)
+                and result['peak_rss_mb'] - base['peak_rss_mb'] > RSS_NOISE_FLOOR_MB):
+            regressions.append(f"{key}: peak RSS {result['peak_rss_mb']:.1f} MB, "
+                               f"baseline {base['peak_rss_mb']:.1f} MB")
+        error_rate = result['errors'] / max(1, result['requests'])
+        base_error_rate = base['errors'] / max(1, base['requests'])
+        if error_rate - base_error_rate > ERROR_RATE_FLOOR:
+            regressions.append(f"{key}: {error_rate:.1%} of requests failed, "
+                               f"baseline {base_error_rate:.1%}")
+    return regressions
+
+def print_result(key, result):
+    rss = f"{result['peak_rss_mb']:.1f}" if result.get('peak_rss_mb') else '?'
+    print(f"{key:<32} {result['rps']:>9.0f} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+          f"{result['p99_ms']:>8.2f} {result['mb_per_s']:>9.1f} {result['errors']:>7} {rss:>9}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark webchef.py servers on a synthetic web root.")
+    parser.add_argument('--targets', default='v2',
+                        help="comma-separated servers to benchmark: v2, v1 (default: v2)")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"comma-separated scenarios (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--concurrency', default='1,8,32',
+                        help="comma-separated connection counts (default: 1,8,32)")
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help="seconds of load per run (default: 3)")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiplies file counts and sizes of the web root (default: 1)")
+    parser.add_argument('--server-args', default='',
+                        help="extra arguments for the v2 server, e.g. '--engine asyncio'")
+    parser.add_argument('--root', help="build the web root here instead of a temp directory")
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help="baseline JSON to compare against (default: benchmarks/baseline.json)")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store these results as the new baseline instead of comparing")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="allowed relative slowdown before failing (default: 0.15)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    targets = [t for t in args.targets.split(',') if t]
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    levels = [int(c) for c in args.concurrency.split(',') if c]
+    for target in targets:
+        if target not in TARGETS:
+            sys.exit(f"Unknown target {target!r}, pick from {', '.join(TARGETS)}")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            sys.exit(f"Unknown scenario {scenario!r}, pick from {', '.join(SCENARIOS)}")
+
+    root = args.root or tempfile.mkdtemp(prefix='webchef-bench-')
+    os.makedirs(root, exist_ok=True)
+    print(f"🧑‍🍳 Preparing the benchmark kitchen in {root} ...")
+    try:
+        workload = build_web_root(root, args.scale)
+        print(f"{'run':<32} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+              f"{'MB/s':>9} {'errors':>7} {'RSS MB':>9}")
+
+        results = {}
+        for target in targets:
+            extra_args = args.server_args.split() if target == 'v2' else []
+            for scenario in scenarios:
+                if scenario in TARGETS[target]['skip']:
+                    print(f"{target}/{scenario:<29} skipped, {target} can't serve it")
+                    continue
+                paths, expected_status = workload[scenario]
+                for concurrency in levels:
+                    process = start_server(target, root, extra_args)
+                    try:
+                        result = run_load(TARGETS[target]['port'], paths, expected_status,
+                                          concurrency, args.duration)
+                        result['peak_rss_mb'] = peak_rss_mb(process)
+                    finally:
+                        stop_server(process)
+                    key = f"{target}/{scenario}/c{concurrency}"
+                    results[key] = result
+                    print_result(key, result)
+    finally:
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"\n📒 Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline} yet; run with --save-baseline to record one.")
+        return 0
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print("\n" + "!" * 60)
+        print(f"🔥 {len(regressions)} PERFORMANCE REGRESSION(S) against {args.baseline}:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        print("!" * 60)
+        return 1
+    print(f"\n✅ No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,24 +2,284 @@
 
 import socket
 import os
+import sys
 import threading
+import queue
+import asyncio
+import concurrent.futures
 import mimetypes
 import time
 import datetime
+import collections
+import html
+import urllib.parse
+import email.utils
+import fnmatch
+import functools
+import copy
+import secrets
+import zlib
+import argparse
+import mmap
+import signal
+import bisect
+import selectors
+import struct
+import zipfile
+import tarfile
+import heapq
+import stat
+import random
+import json
+import cProfile
+import pstats
+import tracemalloc
+import tempfile
 
 # --- Configuration ---
 HOST = '127.0.0.1'
 PORT = 8080
 WEB_ROOT = os.getcwd()
 
+# Size of the body slice that rides along with the headers, and of each read
+# when the zero-copy sendfile path is not available.
+SEND_CHUNK_SIZE = 64 * 1024
+USE_SENDFILE = hasattr(os, 'sendfile')
+
+# Worker pool: a fixed number of cooks take orders from a bounded queue.
+# When the queue is full new customers get a quick 503 instead of waiting.
+WORKER_THREADS = 32
+QUEUE_SIZE = 64
+LISTEN_BACKLOG = 128
+RETRY_AFTER_SECONDS = 1
+
+# Serving engine: 'threads' runs the worker pool above, 'asyncio' multiplexes
+# every connection on one event loop and only uses a few helper threads for
+# disk work, which suits many idle or slow clients.
+ENGINE = 'threads'
+ASYNC_EXECUTOR_THREADS = 4
+
+# Worker processes (--workers). Each one runs the engine above; they share the
+# port through SO_REUSEPORT where the OS has it, or one pre-forked socket.
+WORKERS = 1
+WORKER_RESTART_DELAY = 1.0
+WORKER_SHUTDOWN_TIMEOUT = 5.0
+
+# Live metrics in Prometheus text format (None turns the endpoint off), and
+# the upper bounds in seconds of the latency histogram buckets
+METRICS_PATH = '/__metrics'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Access log: one line per request in 'common' or 'combined' (Apache/NGINX)
+# format or as 'json' lines. ACCESS_LOG is a file path, '-' for stdout or None
+# to turn it off. Lines are written in batches by a background thread; a
+# sample rate below 1.0 logs only that share of requests (5xx always). If the
+# writer falls ACCESS_LOG_MAX_PENDING lines behind, new lines are dropped.
+# LOG_LEVEL 'debug' also prints every arrival, order and dish as it happens.
+ACCESS_LOG = '-'
+ACCESS_LOG_FORMAT = 'combined'
+ACCESS_LOG_SAMPLE_RATE = 1.0
+ACCESS_LOG_FLUSH_INTERVAL = 0.5
+ACCESS_LOG_BATCH_SIZE = 512
+ACCESS_LOG_MAX_PENDING = 50000
+LOG_LEVEL = 'info'
+
+# Profiling (--profile): PROFILE_SAMPLE_RATE of requests are prepared under
+# cProfile; the aggregated stats go to PROFILE_OUTPUT + '.pstats' every
+# PROFILE_DUMP_INTERVAL seconds and at shutdown (read them with
+# `python3 -m pstats`). Every request's phases (parse, resolve, open, send)
+# are timed, and requests slower than SLOW_REQUEST_THRESHOLD seconds are
+# logged with that breakdown. TRACEMALLOC (--tracemalloc) writes a snapshot
+# of where memory was allocated to PROFILE_OUTPUT + '.tracemalloc' at shutdown.
+# Outputs land in the temp directory so the web root stays untouched.
+PROFILE = False
+PROFILE_SAMPLE_RATE = 0.01
+PROFILE_OUTPUT = os.path.join(tempfile.gettempdir(), 'webchef-profile')
+PROFILE_DUMP_INTERVAL = 30
+SLOW_REQUEST_THRESHOLD = 0.5
+TRACEMALLOC = False
+TRACEMALLOC_FRAMES = 10
+
+# Persistent connections: how long an idle connection may wait for its next
+# request, and how many requests one connection may carry before we close it.
+KEEPALIVE_TIMEOUT = 5
+MAX_KEEPALIVE_REQUESTS = 100
+
+# How long a cook of the threaded engine keeps a kept-alive connection after
+# answering, in case its next request follows right away, before handing it
+# back to the waiting room. Saves the trip through the selector for busy
+# clients while holding the cook only briefly.
+KEEPALIVE_LINGER = 0.005
+RECV_SIZE = 4096
+
+# Slow clients: a request head must arrive within HEADER_TIMEOUT seconds, and
+# a client must take at least SEND_SLICE_SIZE bytes of a response every
+# SEND_TIMEOUT seconds. A reaper thread closes connections that overstay these
+# deadlines (or KEEPALIVE_TIMEOUT while idle) every REAPER_INTERVAL seconds.
+# Connections beyond MAX_CONNECTIONS, or MAX_CONNECTIONS_PER_IP from one
+# address, get a quick 503. Limits apply per worker process. In the threaded
+# engine a connection only holds one of the WORKER_THREADS cooks while a
+# request is being served; heads being sent and idle keep-alive connections
+# wait in the accepting thread's selector, so the per-IP cap may exceed the
+# pool size without one address starving everyone else.
+HEADER_TIMEOUT = 10
+SEND_TIMEOUT = 30
+SEND_SLICE_SIZE = 256 * 1024
+REAPER_INTERVAL = 0.5
+MAX_CONNECTIONS = 1024
+MAX_CONNECTIONS_PER_IP = 64
+
+# Fair shares under contention; 0 switches a limit off. Each client IP may make
+# RATE_LIMIT_REQUESTS requests per second, in bursts of up to RATE_LIMIT_BURST,
+# and gets a 429 with Retry-After beyond that. At most RATE_LIMIT_CLIENTS IPs
+# are tracked; idle ones are forgotten first. Responses are paced to
+# CONNECTION_BANDWIDTH bytes/s per connection and TOTAL_BANDWIDTH bytes/s for
+# the whole kitchen, sent in BANDWIDTH_SLICE_SIZE pieces while either is on.
+RATE_LIMIT_REQUESTS = 0
+RATE_LIMIT_BURST = 50
+RATE_LIMIT_CLIENTS = 10000
+CONNECTION_BANDWIDTH = 0
+TOTAL_BANDWIDTH = 0
+BANDWIDTH_SLICE_SIZE = 16 * 1024
+
+# Request limits: oversized heads or too many headers get a 431, bodies
+# (which webchef never needs) over MAX_REQUEST_BODY_SIZE get a 413.
+MAX_REQUEST_HEAD_SIZE = 64 * 1024
+MAX_REQUEST_HEADERS = 100
+MAX_REQUEST_BODY_SIZE = 64 * 1024
+
+# In-memory cache for hot small files. Entries keep the encoded headers and
+# the body, are rechecked against mtime/size at most every
+# CONTENT_CACHE_REVALIDATE seconds and evicted least-recently-used first.
+# Set CONTENT_CACHE_SIZE to 0 to always read from disk.
+CONTENT_CACHE_SIZE = 32 * 1024 * 1024
+CONTENT_CACHE_MAX_FILE_SIZE = 256 * 1024
+CONTENT_CACHE_REVALIDATE = 1.0
+
+# What URL paths resolve to (file, directory to list, or nothing) is kept for
+# PATH_CACHE_TTL seconds, so repeat requests skip the stat calls and MIME
+# lookup. Misses are remembered for PATH_CACHE_NEGATIVE_TTL seconds, which
+# keeps favicon.ico probes and other recurring 404s off the disk.
+PATH_CACHE_SIZE = 10000
+PATH_CACHE_TTL = 1.0
+PATH_CACHE_NEGATIVE_TTL = 1.0
+
+# Directory listings are streamed a page at a time. ?page=, ?per_page=,
+# ?sort=name|size|mtime, ?order=asc|desc and ?format=json pick the view; only
+# the entries up to the requested page are held in memory while scanning, so
+# pages reach at most LISTING_MAX_DEPTH entries in (?order=desc lists the far
+# end of a bigger directory); a deeper ?page= shows the last page in reach.
+LISTING_PAGE_SIZE = 1000
+LISTING_MAX_PAGE_SIZE = 10000
+LISTING_MAX_DEPTH = 100000
+LISTING_CHUNK_SIZE = 16 * 1024
+
+# ?download=zip or ?download=tar on a directory streams the whole tree (minus
+# hidden files) as an archive built on the fly. Files that are compressed
+# already are stored as they are in zips instead of being deflated again.
+ARCHIVE_DOWNLOADS = True
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+ARCHIVE_STORED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.jar', '.apk',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.heic',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.mp4', '.m4v', '.mkv', '.webm', '.mov', '.avi',
+    '.woff', '.woff2', '.docx', '.xlsx', '.pptx', '.epub',
+}
+
+# Site packs: --build-pack snapshots the web root into a single file with a
+# sorted path index, MIME types, validators, gzip variants and the default
+# listing of every directory. --pack (SITE_PACK) serves from a read-only mmap
+# of it: bodies are slices of the mapping, with no open() or stat() per
+# request, and worker processes share the mapped pages. Other listing views
+# and archive downloads still come from the live directory.
+SITE_PACK = None
+PACK_COPY_SIZE = 1024 * 1024
+
+# Cache-Control header per path, first match wins. Patterns are shell-style
+# and matched against the path below the web root, so both '/assets/*' and
+# '*.css' work. 'no-cache' lets browsers keep files but revalidate them with
+# ETag/Last-Modified, which is answered with a cheap 304.
+CACHE_CONTROL_RULES = [
+    # ('*.css', 'public, max-age=3600'),
+    ('*', 'no-cache'),
+]
+
+# A Range header asking for more pieces than this is ignored and the whole
+# file is sent instead. Overlapping and adjacent ranges are merged first
+# (RFC 7233 section 6.1), so no byte is sent twice and a response never
+# outgrows the file.
+MAX_RANGES = 16
+
+# gzip for text-like responses. Clients that accept gzip get a `.gz` sidecar
+# when one sits next to the file, otherwise the body is compressed on the fly
+# (up to COMPRESS_MAX_FILE_SIZE) and kept in a cache of GZIP_CACHE_SIZE bytes.
+COMPRESS_MIN_SIZE = 512
+COMPRESS_MAX_FILE_SIZE = 4 * 1024 * 1024
+COMPRESS_LEVEL = 6
+GZIP_CACHE_SIZE = 16 * 1024 * 1024
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'application/xml',
+    'image/svg+xml',
+}
+
+# Generated bodies (listings, archives) are gzipped as they stream. The
+# compressor is flushed after the first chunk, and after any chunk that took
+# longer than GZIP_FLUSH_AFTER seconds to produce, so what is ready reaches
+# the client instead of waiting in zlib's window.
+GZIP_FLUSH_AFTER = 0.05
+
 request_count = 0
 request_count_lock = threading.Lock()
 
+# In worker processes: the shared per-worker receipt counters, this worker's
+# slot, and what its predecessors in that slot had already recorded there
+_worker_counters = None
+_worker_slot = 0
+_worker_base = None
+
+# Metrics: every thread records into its own shard, so the hot path takes no
+# lock; readers add the shards up
+_metrics_shards = []
+_metrics_shards_lock = threading.Lock()
+_metrics_local = threading.local()
+
+# --profile: the phase timings of the request the current thread is preparing
+_profile_local = threading.local()
+_KNOWN_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'}
+
+# Receipt counters per worker slot: requests, body bytes, responses per
+# status class (1xx-5xx), latency histogram buckets, latency sum in µs, and
+# connections reaped while sending the head, idling and receiving a response
+RECEIPT_FIELDS = 2 + 5 + len(LATENCY_BUCKETS) + 1 + 1 + 3
+REAPED_PHASES = ('header', 'idle', 'send')
+_receipt_totals = None
+
+_connection_queue = None
+
+# Compressed variants keyed by the identity (ETag, or body for error pages)
+# of the uncompressed response they were made from
+_gzip_cache = collections.OrderedDict()
+_gzip_cache_bytes = 0
+_gzip_cache_lock = threading.Lock()
+_GZIP_MISS = object()
+
 start_time = None
 stop_time = None
 
-# Global list to track paths of index.html files created by webchef.py
-_created_index_files = []
+# Pre-encoded so rejecting a connection under load costs next to nothing
+_BUSY_RESPONSE = (
+    "HTTP/1.1 503 Service Unavailable\r\n"
+    "Content-Type: text/plain; charset=utf-8\r\n"
+    "Content-Length: 24\r\n"
+    f"Retry-After: {RETRY_AFTER_SECONDS}\r\n"
+    "Connection: close\r\n"
+    "\r\n"
+    "Kitchen is full, sorry!\n"
+).encode('utf-8')
 
 # --- MIME Types Mapping ---
 def get_mime_type(file_path):
@@ -27,95 +287,1641 @@ def get_mime_type(file_path):
     mime_type, _ = mimetypes.guess_type(file_path)
     return mime_type if mime_type else 'application/octet-stream'
 
-def handle_request(client_socket):
-    """Handles a single client connection and request."""
-    global request_count
+class Response:
+    """
+    A dish ready to be served: status line, headers and the body source.
+    The body is either in-memory bytes or an open file that the serving
+    engine streams to the client and closes afterwards. For files,
+    `segments` lists what to send in order: (offset, count) slices of the
+    file and literal bytes such as multipart boundaries. Bodies generated
+    on the fly are an iterator of byte `chunks` instead; their length is not
+    known up front, so they go out with chunked transfer encoding.
+    """
+
+    def __init__(self, status_code, status_message, content_type, body=b'', file=None, file_size=0):
+        self.keep_alive = False
+        self.status_code = status_code
+        self.status_message = status_message
+        self.content_type = content_type
+        self.body = body
+        self.file = file
+        self.segments = [(0, file_size)] if file is not None else None
+        self.content_length = file_size if file is not None else len(body)
+        self.description = f"{status_code} {status_message}"
+        self.headers = []
+        self.etag = None
+        self.last_modified = None
+        self.accept_ranges = False
+        self.file_path = None
+        self.head_prefix = None
+        self.chunks = None
+        self.chunked = True
+        # Precompressed body, for responses sliced out of a site pack
+        self.gzip_body = None
+        # Set once sending starts; past that point an error page would land
+        # inside the body, so failures can only close the connection
+        self.head_sent = False
+
+    def prefix(self):
+        """Returns the encoded status line and headers, minus the Connection header."""
+        if self.head_prefix is None:
+            headers = [f"HTTP/1.1 {self.status_code} {self.status_message}"]
+            if self.status_code != 304:
+                headers.append(f"Content-Type: {self.content_type}")
+                if self.chunks is None:
+                    headers.append(f"Content-Length: {self.content_length}")
+                elif self.chunked:
+                    headers.append("Transfer-Encoding: chunked")
+            headers.extend(f"{name}: {value}" for name, value in self.headers)
+            headers.append("")
+            self.head_prefix = "\r\n".join(headers).encode('utf-8')
+        return self.head_prefix
+
+    def head(self):
+        """Returns the encoded status line and headers."""
+        return self.prefix() + (_KEEP_ALIVE_END if self.keep_alive else _CLOSE_END)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.chunks is not None and hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+class Request:
+    """A parsed request head. Header names in `headers` are lower-cased."""
+
+    def __init__(self, method, target, path, query, http_version, headers):
+        self.method = method
+        self.target = target
+        self.path = path
+        self.query = query
+        self.http_version = http_version
+        self.headers = headers
+        # Set when the request carries a body we can't skip (chunked uploads)
+        self.unread_body = False
+        # Seconds per phase, kept in --profile mode
+        self.phases = None
+
+class RequestError(Exception):
+    """A request that must be refused with `status_code` before routing it."""
+
+    def __init__(self, status_code, status_message):
+        super().__init__(f"{status_code} {status_message}")
+        self.status_code = status_code
+        self.status_message = status_message
+
+class RequestParser:
+    """
+    Incremental parser for the requests arriving on one connection. Feed it
+    whatever recv() returned; next_request() hands out complete requests in
+    order, so pipelined requests sharing one read are handled too. Request
+    bodies up to MAX_REQUEST_BODY_SIZE are read and discarded to keep the
+    connection usable.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.pending = None
+        self.body_remaining = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_request(self):
+        """Returns the next complete Request, or None until more data is fed."""
+        if self.pending is None:
+            end = self.buffer.find(b'\r\n\r\n', self.scanned)
+            if end == -1:
+                if len(self.buffer) > MAX_REQUEST_HEAD_SIZE:
+                    raise RequestError(431, "Request Header Fields Too Large")
+                # The terminator may straddle the next read
+                self.scanned = max(0, len(self.buffer) - 3)
+                return None
+            if end > MAX_REQUEST_HEAD_SIZE:
+                raise RequestError(431, "Request Header Fields Too Large")
+
+            started = time.perf_counter()
+            self.pending = parse_request_head(bytes(self.buffer[:end]))
+            if PROFILE:
+                self.pending.phases = {'parse': time.perf_counter() - started}
+            del self.buffer[:end + 4]
+            self.scanned = 0
+            self.body_remaining = request_body_length(self.pending)
+
+        if self.body_remaining:
+            skipped = min(self.body_remaining, len(self.buffer))
+            del self.buffer[:skipped]
+            self.body_remaining -= skipped
+            if self.body_remaining:
+                return None
+
+        request, self.pending = self.pending, None
+        return request
+
+def parse_request_head(head):
+    """Parses the request line and headers of a request head given as bytes."""
+    lines = head.split(b'\r\n')
+    if len(lines) - 1 > MAX_REQUEST_HEADERS:
+        raise RequestError(431, "Request Header Fields Too Large")
+
+    parts = lines[0].split(b' ')
+    if len(parts) != 3 or not parts[0] or not parts[2].startswith(b'HTTP/'):
+        raise RequestError(400, "Bad Request")
+    method = parts[0].decode('ascii', 'replace')
+    target = parts[1].decode('ascii', 'replace')
+    http_version = parts[2].decode('ascii', 'replace')
+
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(b':')
+        if not separator or not name or name != name.strip():
+            raise RequestError(400, "Bad Request")
+        headers[name.lower().decode('latin-1')] = value.strip().decode('latin-1')
+
+    raw_path, _, query = parts[1].partition(b'?')
+    path = normalize_path(raw_path)
+    return Request(method, target, path, query.decode('latin-1'), http_version, headers)
+
+def normalize_path(raw_path):
+    """
+    Percent-decodes a URL path and collapses empty and '.' segments.
+    '..' segments are kept so routing can refuse them. Bytes that aren't
+    valid UTF-8 are kept as surrogate escapes, the way os.fsdecode() names
+    such files, so listing links to them lead somewhere.
+    """
+    if not raw_path.startswith(b'/'):
+        raise RequestError(400, "Bad Request")
+    path = urllib.parse.unquote_to_bytes(raw_path).decode('utf-8', 'surrogateescape')
+    if '\x00' in path:
+        raise RequestError(400, "Bad Request")
+
+    segments = [segment for segment in path.split('/') if segment and segment != '.']
+    if not segments:
+        return '/'
+    normalized = '/' + '/'.join(segments)
+    return normalized + '/' if path.endswith('/') else normalized
+
+def request_body_length(request):
+    """Returns how many body bytes follow the request head, refusing large bodies."""
+    if 'transfer-encoding' in request.headers:
+        request.unread_body = True
+        return 0
+    try:
+        length = int(request.headers.get('content-length', '0'))
+    except ValueError:
+        raise RequestError(400, "Bad Request")
+    if length < 0:
+        raise RequestError(400, "Bad Request")
+    if length > MAX_REQUEST_BODY_SIZE:
+        raise RequestError(413, "Payload Too Large")
+    return length
+
+_KEEP_ALIVE_END = b"Connection: keep-alive\r\n\r\n"
+_CLOSE_END = b"Connection: close\r\n\r\n"
+_LAST_CHUNK = b"0\r\n\r\n"
+
+class ContentCache:
+    """
+    Byte-budgeted LRU cache of small file responses, keyed by requested path.
+    Hits are served straight from memory without opening the file.
+    """
+
+    def __init__(self, max_bytes, max_file_size, revalidate_after):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate_after = revalidate_after
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def accepts(self, size):
+        return size <= self.max_file_size and size <= self.max_bytes
+
+    def get(self, key):
+        """Returns a fresh Response for `key`, or None if it is not cached or stale."""
+        if not self.max_bytes:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+
+        file_path, mtime_ns, size, checked_at, template = entry
+        now = time.monotonic()
+        if now - checked_at >= self.revalidate_after:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                st = None
+            if st is None or st.st_mtime_ns != mtime_ns or st.st_size != size:
+                self.discard(key)
+                with self.lock:
+                    self.misses += 1
+                return None
+            entry[3] = now
+
+        with self.lock:
+            self.hits += 1
+        return copy.copy(template)
+
+    def put(self, key, file_path, st, response):
+        """Stores a fully read 200 response for `key`."""
+        response.prefix()
+        entry = [file_path, st.st_mtime_ns, st.st_size, time.monotonic(), copy.copy(response)]
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[4].content_length
+            self.entries[key] = entry
+            self.total_bytes += response.content_length
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted[4].content_length
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[4].content_length
+
+content_cache = ContentCache(CONTENT_CACHE_SIZE, CONTENT_CACHE_MAX_FILE_SIZE, CONTENT_CACHE_REVALIDATE)
+
+# kind is 'file', 'dir' (a directory to list) or 'missing'; file_path is what
+# to serve, so a directory with an index.html resolves to that file
+ResolvedPath = collections.namedtuple('ResolvedPath', 'kind file_path st mime_type expires')
+
+class PathCache:
+    """
+    Bounded LRU of ResolvedPath entries keyed by requested path. Entries
+    expire after a fixed time instead of being revalidated, so a hit costs
+    no syscall at all.
+    """
+
+    def __init__(self, max_entries, ttl, negative_ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the unexpired ResolvedPath for `key`, or None."""
+        if not self.max_entries:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.expires <= time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, kind, file_path=None, st=None, mime_type=None):
+        """Stores and returns a new entry for `key`."""
+        ttl = self.negative_ttl if kind == 'missing' else self.ttl
+        entry = ResolvedPath(kind, file_path, st, mime_type, time.monotonic() + ttl)
+        if self.max_entries:
+            with self.lock:
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return entry
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+path_cache = PathCache(PATH_CACHE_SIZE, PATH_CACHE_TTL, PATH_CACHE_NEGATIVE_TTL)
+
+def resolve_path(file_path):
+    """
+    Works out what a path below the web root is with a single stat (plus one
+    for index.html when it is a directory), using the path cache.
+    """
+    resolved = path_cache.get(file_path)
+    if resolved is not None:
+        return resolved
+
+    try:
+        st = os.stat(file_path)
+    except (OSError, ValueError):
+        return path_cache.put(file_path, 'missing')
+
+    if stat.S_ISDIR(st.st_mode):
+        index_path = os.path.join(file_path, 'index.html')
+        try:
+            index_st = os.stat(index_path)
+        except (OSError, ValueError):
+            index_st = None
+        if index_st is not None and stat.S_ISREG(index_st.st_mode):
+            return path_cache.put(file_path, 'file', index_path, index_st, get_mime_type(index_path))
+        return path_cache.put(file_path, 'dir', file_path, st)
+
+    if stat.S_ISREG(st.st_mode):
+        return path_cache.put(file_path, 'file', file_path, st, get_mime_type(file_path))
+    return path_cache.put(file_path, 'missing')
+
+def wants_keep_alive(request):
+    """Decides whether the connection may stay open after this request."""
+    if request.unread_body:
+        return False
+
+    connection = request.headers.get('connection', '').lower()
+    if request.http_version == 'HTTP/1.1':
+        return 'close' not in connection
+    return 'keep-alive' in connection
+
+def prepare_response(request):
+    """Turns a parsed Request into a Response. Shared by all serving engines."""
     try:
-        request_data_bytes = client_socket.recv(4096)
-        if not request_data_bytes:
+        headers = request.headers
+        log('debug', f"👨‍🍳 Request: {request.method} {request.target} {request.http_version}")
+        if METRICS_PATH and request.path == METRICS_PATH and request.method == 'GET':
+            response = metrics_response()
+        else:
+            response = route_request(request.method, request.path, request.query)
+        # Ranges are always served from the uncompressed file
+        if 'range' not in headers and accepts_gzip(headers.get('accept-encoding', '')):
+            response = gzip_response(response)
+        if is_not_modified(response, headers):
+            response.close()
+            response = not_modified_response(response)
+        elif 'range' in headers and response.accept_ranges:
+            response = range_response(response, headers['range'], headers.get('if-range'))
+        response.keep_alive = wants_keep_alive(request)
+        if response.chunks is not None and request.http_version != 'HTTP/1.1':
+            # HTTP/1.0 has no chunked encoding; closing the connection ends the body
+            response.chunked = False
+            response.keep_alive = False
+        return response
+    except Exception as e:
+        log('warning', f"Oops! A kitchen mishap: {e}")
+        return error_response(500, "Internal Server Error")
+
+def route_request(method, path, query=''):
+    """Maps a method, URL path and query string to the Response that should be served."""
+    if method != 'GET':
+        return error_response(501, "Not Implemented")
+
+    # Hidden files and anything trying to climb out of the web root ('..')
+    if '/.' in path:
+        return error_response(403, "Forbidden")
+
+    requested_file_absolute = os.path.join(WEB_ROOT, path[1:])
+
+    # Only the default view of a listing is cached; files ignore the query
+    listing = parse_listing_query(query) if query else DEFAULT_LISTING
+    archive = archive_format(query) if query else None
+    if site_pack is not None and listing == DEFAULT_LISTING and archive is None:
+        started = time.perf_counter()
+        response = site_pack.response(path)
+        add_phase('resolve', started)
+        if response is not None:
+            return response
+        log('debug', f"Ingredient not in the pack: {display_name(path)}")
+        return error_response(404, "Not Found")
+
+    cache_key = requested_file_absolute if listing == DEFAULT_LISTING and archive is None else None
+    if cache_key is not None:
+        cached_response = content_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+
+    started = time.perf_counter()
+    resolved = resolve_path(requested_file_absolute)
+    add_phase('resolve', started)
+    if archive is not None and resolved.kind != 'missing' and (
+            resolved.kind == 'dir' or resolved.file_path != requested_file_absolute):
+        return archive_response(requested_file_absolute, archive)
+    started = time.perf_counter()
+    if resolved.kind == 'dir':
+        try:
+            return directory_response(resolved.file_path, cache_key, resolved.st, listing)
+        except FileNotFoundError:
+            path_cache.discard(requested_file_absolute)
+        finally:
+            add_phase('open', started)
+    elif resolved.kind == 'file':
+        response = file_response(200, "OK", resolved.mime_type, resolved.file_path, requested_file_absolute)
+        add_phase('open', started)
+        if response.status_code == 404:
+            # Removed since it was resolved; don't keep pointing at it
+            path_cache.discard(requested_file_absolute)
+        return response
+
+    log('debug', f"Ingredient not found: {display_name(requested_file_absolute)}")
+    return error_response(404, "Not Found")
+
+def file_response(status_code, status_message, content_type, file_path, cache_key=None):
+    """
+    Opens a file for serving; its body is streamed by the engine.
+    Small files are read into memory instead and stored in the content
+    cache under `cache_key`.
+    """
+    try:
+        f = open(file_path, 'rb')
+    except FileNotFoundError:
+        log('debug', f"Error: Ingredient missing when preparing dish: {file_path}")
+        return error_response(404, "Not Found")
+
+    st = os.fstat(f.fileno())
+    if cache_key is not None and content_cache.max_bytes and content_cache.accepts(st.st_size):
+        with f:
+            body = f.read()
+        response = Response(status_code, status_message, content_type, body=body)
+        response.description += f" for {display_name(os.path.basename(file_path))}"
+        set_file_headers(response, st, file_path)
+        if len(body) == st.st_size:
+            content_cache.put(cache_key, file_path, st, response)
+        return response
+
+    response = Response(status_code, status_message, content_type,
+                        file=f, file_size=st.st_size)
+    response.description += f" for {display_name(os.path.basename(file_path))}"
+    set_file_headers(response, st, file_path)
+    return response
+
+def set_file_headers(response, st, file_path):
+    """Adds the headers every file response carries."""
+    set_validators(response, st, file_path)
+    response.file_path = file_path
+    response.accept_ranges = True
+    response.headers.append(('Accept-Ranges', 'bytes'))
+    if is_compressible(response.content_type):
+        response.headers.append(('Vary', 'Accept-Encoding'))
+
+def set_validators(response, st, file_path, variant=None):
+    """
+    Adds ETag, Last-Modified and Cache-Control headers derived from a stat
+    result. `variant` tells apart different renderings of the same file.
+    """
+    response.etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+    if variant:
+        response.etag = response.etag[:-1] + f'-{variant}"'
+    response.last_modified = int(st.st_mtime)
+    response.headers.append(('ETag', response.etag))
+    response.headers.append(('Last-Modified', email.utils.formatdate(response.last_modified, usegmt=True)))
+    response.headers.append(('Cache-Control', cache_control_for(file_path)))
+
+@functools.lru_cache(maxsize=1024)
+def cache_control_for(file_path):
+    """Returns the Cache-Control value of the first matching CACHE_CONTROL_RULES pattern."""
+    relative_path = '/' + os.path.relpath(file_path, WEB_ROOT).replace(os.sep, '/')
+    for pattern, value in CACHE_CONTROL_RULES:
+        if fnmatch.fnmatchcase(relative_path, pattern):
+            return value
+    return 'no-cache'
+
+def is_not_modified(response, headers):
+    """Evaluates If-None-Match / If-Modified-Since against a 200 response."""
+    if response.status_code != 200 or response.etag is None:
+        return False
+
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == response.etag:
+                return True
+        return False
+
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since is not None:
+        parsed = email.utils.parsedate_tz(if_modified_since)
+        if parsed is None:
+            return False
+        return response.last_modified <= email.utils.mktime_tz(parsed)
+
+    return False
+
+def parse_range_header(range_header, size):
+    """
+    Parses a bytes Range header into inclusive (start, end) pairs clamped to
+    `size`, in order with overlapping and adjacent ones merged. Returns None
+    if the header is malformed and must be ignored, or an empty list if none
+    of the ranges can be satisfied.
+    """
+    unit, separator, specs = range_header.partition('=')
+    if not separator or unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, dash, last = spec.partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                # "-500" means the last 500 bytes
+                suffix_length = int(last)
+                if suffix_length <= 0:
+                    continue
+                start, end = max(size - suffix_length, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last.strip() else None
+                if end is not None and end < start:
+                    return None
+                end = size - 1 if end is None else min(end, size - 1)
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def if_range_matches(response, if_range):
+    """True if the If-Range validator still describes the current file."""
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == response.etag
+    parsed = email.utils.parsedate_tz(if_range)
+    return parsed is not None and response.last_modified == email.utils.mktime_tz(parsed)
+
+def range_response(response, range_header, if_range=None):
+    """
+    Turns a 200 file response into a 206 for the requested byte ranges.
+    One range is sent as a plain slice, several as multipart/byteranges.
+    Unusable or outdated (If-Range) requests get the full response back.
+    """
+    size = response.content_length
+    ranges = parse_range_header(range_header, size)
+    if ranges is None or (if_range is not None and not if_range_matches(response, if_range)):
+        return response
+
+    if not ranges:
+        response.close()
+        unsatisfiable = error_response(416, "Range Not Satisfiable")
+        unsatisfiable.headers.append(('Content-Range', f"bytes */{size}"))
+        return unsatisfiable
+
+    partial = copy.copy(response)
+    partial.status_code = 206
+    partial.status_message = "Partial Content"
+    partial.description = response.description.replace("200 OK", "206 Partial Content", 1)
+    partial.head_prefix = None
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        partial.headers = response.headers + [('Content-Range', f"bytes {start}-{end}/{size}")]
+        partial.content_length = end - start + 1
+        if response.file is None:
+            partial.body = response.body[start:end + 1]
+        else:
+            partial.segments = [(start, end - start + 1)]
+        return partial
+
+    boundary = secrets.token_hex(12)
+    segments = []
+    for start, end in ranges:
+        segments.append((
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode('utf-8'))
+        if response.file is None:
+            segments.append(response.body[start:end + 1])
+        else:
+            segments.append((start, end - start + 1))
+    segments.append(f"\r\n--{boundary}--\r\n".encode('utf-8'))
+
+    partial.content_type = f"multipart/byteranges; boundary={boundary}"
+    partial.headers = list(response.headers)
+    partial.content_length = sum(
+        segment[1] if isinstance(segment, tuple) else len(segment) for segment in segments)
+    if response.file is None:
+        partial.body = b''.join(segments)
+    else:
+        partial.segments = segments
+    return partial
+
+def accepts_gzip(accept_encoding):
+    """True if an Accept-Encoding header allows gzip (q-values of 0 refuse it)."""
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        if coding.strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        name, _, value = params.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                return float(value) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+def is_compressible(content_type):
+    if not content_type:
+        return False
+    base_type = content_type.split(';', 1)[0].strip().lower()
+    return base_type.startswith('text/') or base_type in COMPRESSIBLE_TYPES
+
+def gzip_response(response):
+    """
+    Returns the gzip-encoded variant of a 200 or error response, or the
+    response itself when its type is not worth compressing. The encoded body
+    is a fresh `.gz` sidecar next to the file, streamed from disk so a rebuilt
+    one is picked up right away, or else compressed on the fly and kept in
+    the compressed cache.
+    """
+    if response.status_code != 200 and response.status_code < 400:
+        return response
+    if response.gzip_body is not None:
+        return encoded_response(response, body=response.gzip_body)
+    if response.chunks is not None:
+        if not is_compressible(response.content_type):
+            return response
+        encoded = encoded_response(response)
+        encoded.chunks = gzip_chunks(response.chunks)
+        return encoded
+    if response.content_length < COMPRESS_MIN_SIZE or not is_compressible(response.content_type):
+        return response
+
+    sidecar = open_gzip_sidecar(response) if response.file_path else None
+    if sidecar is not None:
+        sidecar_file, sidecar_size = sidecar
+        response.close()
+        return encoded_response(response, file=sidecar_file, file_size=sidecar_size)
+
+    identity = response.etag or response.body
+    compressed = gzip_cache_get(identity)
+    if compressed is _GZIP_MISS:
+        if response.content_length > COMPRESS_MAX_FILE_SIZE:
+            return response
+        if response.file is None:
+            body = response.body
+        else:
+            body = read_file_slice(response.file, 0, response.content_length)
+        compressed = gzip_compress(body)
+        if len(compressed) >= len(body):
+            # Nothing gained; remember that by caching the plain body as is
+            compressed = None
+        gzip_cache_put(identity, compressed)
+
+    if compressed is None:
+        return response
+    response.close()
+    return encoded_response(response, body=compressed)
+
+def gzip_compress(body):
+    # A fixed header mtime keeps the output, and so the ETag, deterministic
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+def gzip_chunks(chunks):
+    """Compresses a chunk stream as it is generated."""
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        first = True
+        started = time.perf_counter()
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if first or time.perf_counter() - started > GZIP_FLUSH_AFTER:
+                compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+                first = False
+            if compressed:
+                yield compressed
+            started = time.perf_counter()
+        yield compressor.flush()
+    finally:
+        chunks.close()
+
+def open_gzip_sidecar(response):
+    """Opens `<file>.gz` if it exists and is not older than the file itself."""
+    try:
+        f = open(response.file_path + '.gz', 'rb')
+    except OSError:
+        return None
+    st = os.fstat(f.fileno())
+    if int(st.st_mtime) < response.last_modified:
+        f.close()
+        return None
+    return f, st.st_size
+
+def encoded_response(response, body=b'', file=None, file_size=0):
+    """Copies `response` with a gzip body in place of the original one."""
+    encoded = copy.copy(response)
+    encoded.body = body
+    encoded.file = file
+    encoded.segments = [(0, file_size)] if file is not None else None
+    encoded.content_length = file_size if file is not None else len(body)
+    encoded.file_path = None
+    encoded.head_prefix = None
+    encoded.description += " (gzip)"
+    if response.etag is not None:
+        encoded.etag = response.etag[:-1] + '-gzip"'
+    encoded.headers = [(name, encoded.etag if name == 'ETag' else value)
+                       for name, value in response.headers]
+    encoded.headers.append(('Content-Encoding', 'gzip'))
+    return encoded
+
+def gzip_cache_get(identity):
+    """
+    Returns the cached compressed body for `identity`, None if compressing
+    it was found not to pay off, or _GZIP_MISS if it is not cached.
+    """
+    with _gzip_cache_lock:
+        compressed = _gzip_cache.get(identity, _GZIP_MISS)
+        if compressed is not _GZIP_MISS:
+            _gzip_cache.move_to_end(identity)
+        return compressed
+
+def _gzip_entry_size(compressed):
+    # "Not worth it" markers still take up a slot, so give them a nominal size
+    return len(compressed) if compressed is not None else 64
+
+def gzip_cache_put(identity, compressed):
+    global _gzip_cache_bytes
+    size = _gzip_entry_size(compressed)
+    if size > GZIP_CACHE_SIZE:
+        return
+    with _gzip_cache_lock:
+        old = _gzip_cache.pop(identity, _GZIP_MISS)
+        if old is not _GZIP_MISS:
+            _gzip_cache_bytes -= _gzip_entry_size(old)
+        _gzip_cache[identity] = compressed
+        _gzip_cache_bytes += size
+        while _gzip_cache_bytes > GZIP_CACHE_SIZE:
+            _, evicted = _gzip_cache.popitem(last=False)
+            _gzip_cache_bytes -= _gzip_entry_size(evicted)
+
+def not_modified_response(response):
+    """Builds a body-less 304 carrying the validators of `response`."""
+    not_modified = Response(304, "Not Modified", None)
+    not_modified.headers = [(name, value) for name, value in response.headers
+                            if name in ('ETag', 'Last-Modified', 'Cache-Control', 'Vary')]
+    not_modified.description = response.description.replace("200 OK", "304 Not Modified", 1)
+    return not_modified
+
+def count_request():
+    global request_count
+    with request_count_lock:
+        request_count += 1
+        if _worker_counters is not None:
+            _worker_counters[_worker_slot * RECEIPT_FIELDS] = _worker_base[0] + request_count
+
+# --- Metrics ---
+class MetricsShard:
+    """Counters written by exactly one thread, so updates need no lock."""
+
+    def __init__(self):
+        self.requests = collections.Counter()
+        self.body_bytes = 0
+        self.open_connections = 0
+        self.rejected_connections = collections.Counter()
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.prepare_latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.prepare_latency_sum = 0.0
+        self.throttled_seconds = 0.0
+        self.phase_seconds = collections.Counter()
+
+def metrics_shard():
+    """Returns the calling thread's shard, registering it on first use."""
+    shard = getattr(_metrics_local, 'shard', None)
+    if shard is None:
+        shard = _metrics_local.shard = MetricsShard()
+        with _metrics_shards_lock:
+            _metrics_shards.append(shard)
+    return shard
+
+def record_request(method, response, started, prepared):
+    """Records one served request; `started`/`prepared` are perf_counter() stamps."""
+    finished = time.perf_counter()
+    shard = metrics_shard()
+    shard.requests[(method if method in _KNOWN_METHODS else 'OTHER', response.status_code)] += 1
+    shard.body_bytes += response.content_length
+    shard.latency[bisect.bisect_left(LATENCY_BUCKETS, finished - started)] += 1
+    shard.latency_sum += finished - started
+    shard.prepare_latency[bisect.bisect_left(LATENCY_BUCKETS, prepared - started)] += 1
+    shard.prepare_latency_sum += prepared - started
+
+def metrics_totals():
+    """Adds up all shards. Reads race with writers, which is fine for metrics."""
+    totals = MetricsShard()
+    with _metrics_shards_lock:
+        shards = list(_metrics_shards)
+    for shard in shards:
+        totals.requests.update(dict(shard.requests))
+        totals.body_bytes += shard.body_bytes
+        totals.open_connections += shard.open_connections
+        totals.rejected_connections.update(dict(shard.rejected_connections))
+        totals.latency_sum += shard.latency_sum
+        totals.prepare_latency_sum += shard.prepare_latency_sum
+        totals.throttled_seconds += shard.throttled_seconds
+        totals.phase_seconds.update(dict(shard.phase_seconds))
+        for i, count in enumerate(list(shard.latency)):
+            totals.latency[i] += count
+        for i, count in enumerate(list(shard.prepare_latency)):
+            totals.prepare_latency[i] += count
+    return totals
+
+def histogram_percentile(counts, quantile):
+    """Estimates a quantile in seconds by interpolating within histogram buckets."""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = quantile * total
+    cumulative = 0
+    for i, count in enumerate(counts):
+        if count and cumulative + count >= rank:
+            lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+            upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1]
+            return lower + (upper - lower) * (rank - cumulative) / count
+        cumulative += count
+    return LATENCY_BUCKETS[-1]
+
+def metrics_response():
+    """Renders the current metrics in the Prometheus text exposition format."""
+    totals = metrics_totals()
+    worker_label = f'worker="{_worker_slot + 1}"' if _worker_counters is not None else ''
+    join = ',' if worker_label else ''
+
+    lines = [
+        "# HELP webchef_requests_total Requests served, by method and status code.",
+        "# TYPE webchef_requests_total counter",
+    ]
+    for (method, status), count in sorted(totals.requests.items()):
+        lines.append(f'webchef_requests_total{{{worker_label}{join}method="{method}",status="{status}"}} {count}')
+    labels = f"{{{worker_label}}}" if worker_label else ''
+    lines += [
+        "# HELP webchef_response_body_bytes_total Response body bytes sent.",
+        "# TYPE webchef_response_body_bytes_total counter",
+        f"webchef_response_body_bytes_total{labels} {totals.body_bytes}",
+        "# HELP webchef_open_connections Client connections currently open.",
+        "# TYPE webchef_open_connections gauge",
+        f"webchef_open_connections{labels} {totals.open_connections}",
+        "# HELP webchef_rejected_connections_total Connections turned away with a 503, by reason.",
+        "# TYPE webchef_rejected_connections_total counter",
+    ]
+    for reason in ('queue_full', 'max_connections', 'per_ip'):
+        lines.append(f'webchef_rejected_connections_total{{{worker_label}{join}reason="{reason}"}} '
+                     f'{totals.rejected_connections[reason]}')
+    lines += [
+        "# HELP webchef_reaped_connections_total Connections closed by the reaper, by the phase they overstayed.",
+        "# TYPE webchef_reaped_connections_total counter",
+    ]
+    for phase in REAPED_PHASES:
+        lines.append(f'webchef_reaped_connections_total{{{worker_label}{join}phase="{phase}"}} '
+                     f'{connection_tracker.reaped[phase]}')
+    lines += [
+        "# HELP webchef_queued_connections Accepted connections waiting for a worker thread.",
+        "# TYPE webchef_queued_connections gauge",
+        f"webchef_queued_connections{labels} {_connection_queue.qsize() if _connection_queue else 0}",
+        "# HELP webchef_content_cache_hits_total Requests answered from the in-memory content cache.",
+        "# TYPE webchef_content_cache_hits_total counter",
+        f"webchef_content_cache_hits_total{labels} {content_cache.hits}",
+        "# HELP webchef_content_cache_misses_total Content cache lookups that had to go to disk.",
+        "# TYPE webchef_content_cache_misses_total counter",
+        f"webchef_content_cache_misses_total{labels} {content_cache.misses}",
+        "# HELP webchef_path_cache_hits_total Path resolutions answered from the path cache, 404s included.",
+        "# TYPE webchef_path_cache_hits_total counter",
+        f"webchef_path_cache_hits_total{labels} {path_cache.hits}",
+        "# HELP webchef_path_cache_misses_total Path resolutions that had to stat the file system.",
+        "# TYPE webchef_path_cache_misses_total counter",
+        f"webchef_path_cache_misses_total{labels} {path_cache.misses}",
+        "# HELP webchef_access_log_dropped_total Access log lines dropped because the writer fell behind.",
+        "# TYPE webchef_access_log_dropped_total counter",
+        f"webchef_access_log_dropped_total{labels} {access_log.dropped}",
+        "# HELP webchef_rate_limited_requests_total Requests answered with a 429 by the rate limiter.",
+        "# TYPE webchef_rate_limited_requests_total counter",
+        f"webchef_rate_limited_requests_total{labels} {rate_limiter.limited}",
+        "# HELP webchef_rate_limit_clients Client IPs the rate limiter currently keeps a bucket for.",
+        "# TYPE webchef_rate_limit_clients gauge",
+        f"webchef_rate_limit_clients{labels} {len(rate_limiter.buckets)}",
+        "# HELP webchef_throttled_seconds_total Time responses spent waiting for the bandwidth caps.",
+        "# TYPE webchef_throttled_seconds_total counter",
+        f"webchef_throttled_seconds_total{labels} {totals.throttled_seconds:.3f}",
+    ]
+    if totals.phase_seconds:
+        lines += [
+            "# HELP webchef_phase_seconds_total Time spent per request phase (--profile only).",
+            "# TYPE webchef_phase_seconds_total counter",
+        ]
+        for phase, seconds in sorted(totals.phase_seconds.items()):
+            lines.append(f'webchef_phase_seconds_total{{{worker_label}{join}phase="{phase}"}} {seconds:.6f}')
+    lines += histogram_lines(
+        'webchef_request_duration_seconds',
+        "Time from a complete request to the last byte handed to the socket.",
+        totals.latency, totals.latency_sum, worker_label)
+    lines += histogram_lines(
+        'webchef_prepare_duration_seconds',
+        "Time spent routing, reading disk and rendering listings before sending.",
+        totals.prepare_latency, totals.prepare_latency_sum, worker_label)
+
+    response = Response(200, "OK", "text/plain; version=0.0.4; charset=utf-8",
+                        body=("\n".join(lines) + "\n").encode('utf-8'))
+    response.headers.append(('Cache-Control', 'no-store'))
+    response.description += " for metrics"
+    return response
+
+def histogram_lines(name, help_text, counts, total_sum, worker_label):
+    join = ',' if worker_label else ''
+    labels = f"{{{worker_label}}}" if worker_label else ''
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{worker_label}{join}le="{bound}"}} {cumulative}')
+    lines.append(f"{name}_sum{labels} {total_sum:.6f}")
+    lines.append(f"{name}_count{labels} {cumulative}")
+    return lines
+
+def receipt_vector(totals):
+    """Packs metrics totals into the fixed RECEIPT_FIELDS layout shared with the parent."""
+    status_classes = [0] * 5
+    for (method, status), count in totals.requests.items():
+        if 1 <= status // 100 <= 5:
+            status_classes[status // 100 - 1] += count
+    return ([sum(totals.requests.values()), totals.body_bytes] + status_classes
+            + list(totals.latency) + [int(totals.latency_sum * 1_000_000)]
+            + [connection_tracker.reaped[phase] for phase in REAPED_PHASES])
+
+# --- Logging ---
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30}
+
+def log(level, message):
+    """Prints `message` if `level` is at or above LOG_LEVEL."""
+    if LOG_LEVELS[level] >= LOG_LEVELS[LOG_LEVEL]:
+        print(message)
+
+class AccessLog:
+    """
+    Access log written by a background thread. Request threads only append
+    the raw fields of a request to a deque; formatting and writing happen in
+    batches on the writer thread, so a slow terminal or disk never holds up
+    a cook.
+    """
+
+    def __init__(self):
+        self.pending = collections.deque()
+        self.wakeup = threading.Event()
+        self.stream = None
+        self.thread = None
+        self.running = False
+        self.log_format = ACCESS_LOG_FORMAT
+        self.sample_rate = ACCESS_LOG_SAMPLE_RATE
+        self.dropped = 0
+        self._second = None
+        self._dates = ('', '')
+
+    def start(self, destination, log_format, sample_rate):
+        """Opens `destination` ('-' for stdout) and starts the writer thread."""
+        if not destination:
             return
+        self.log_format = log_format
+        self.sample_rate = sample_rate
+        # Appending keeps lines from several worker processes whole
+        self.stream = sys.stdout if destination == '-' else open(destination, 'a', encoding='utf-8')
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='access-log', daemon=True)
+        self.thread.start()
 
-        request_data = request_data_bytes.decode('utf-8')
+    def stop(self):
+        """Writes out whatever is still pending and closes the log."""
+        if self.thread is None:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+        if self.stream is not sys.stdout:
+            self.stream.close()
+        self.stream = None
 
-        request_lines = request_data.split('\r\n')
-        if not request_lines or not request_lines[0]:
-            send_error(client_socket, 400, "Bad Request")
+    def record(self, client_address, request, status_code, body_bytes, started):
+        """Queues one line; `request` is None when the request could not be parsed."""
+        if self.stream is None:
+            return
+        if self.sample_rate < 1.0 and status_code < 500 and random.random() >= self.sample_rate:
+            return
+        if len(self.pending) >= ACCESS_LOG_MAX_PENDING:
+            self.dropped += 1
             return
+        self.pending.append((time.time(), time.perf_counter() - started, client_address,
+                             request, status_code, body_bytes))
+        if len(self.pending) == ACCESS_LOG_BATCH_SIZE:
+            self.wakeup.set()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(ACCESS_LOG_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.write_pending()
+        self.write_pending()
+
+    def write_pending(self):
+        lines = []
+        try:
+            while True:
+                lines.append(self.format(self.pending.popleft()))
+        except IndexError:
+            pass
+        if lines:
+            try:
+                self.stream.write("\n".join(lines) + "\n")
+                self.stream.flush()
+            except (OSError, ValueError):
+                self.dropped += len(lines)
+
+    def format(self, entry):
+        timestamp, duration, client_address, request, status_code, body_bytes = entry
+        clf_date, iso_date = self.dates(timestamp)
+        remote = client_address[0] if client_address else '-'
+        headers = request.headers if request is not None else {}
+
+        if self.log_format == 'json':
+            return json.dumps({
+                'time': iso_date,
+                'remote_addr': remote,
+                'method': request.method if request is not None else None,
+                'target': request.target if request is not None else None,
+                'protocol': request.http_version if request is not None else None,
+                'status': status_code,
+                'body_bytes': body_bytes,
+                'duration_ms': round(duration * 1000, 3),
+                'referer': headers.get('referer'),
+                'user_agent': headers.get('user-agent'),
+            }, ensure_ascii=False)
+
+        request_line = (f"{request.method} {request.target} {request.http_version}"
+                        if request is not None else '-')
+        line = (f'{remote} - - [{clf_date}] "{clf_escape(request_line)}" '
+                f'{status_code} {body_bytes or "-"}')
+        if self.log_format == 'combined':
+            line += (f' "{clf_escape(headers.get("referer", "-"))}"'
+                     f' "{clf_escape(headers.get("user-agent", "-"))}"')
+        return line
+
+    def dates(self, timestamp):
+        """CLF and ISO 8601 local times, formatted once per second."""
+        second = int(timestamp)
+        if second != self._second:
+            local = time.localtime(second)
+            self._second = second
+            self._dates = (time.strftime('%d/%b/%Y:%H:%M:%S %z', local),
+                           time.strftime('%Y-%m-%dT%H:%M:%S%z', local))
+        return self._dates
 
-        first_line = request_lines[0]
-        parts = first_line.split(' ')
+def clf_escape(value):
+    """Escapes quotes, backslashes and control characters for a quoted log field."""
+    return value.encode('unicode_escape').decode('ascii').replace('"', '\\"')
 
-        if len(parts) < 3:
-            send_error(client_socket, 400, "Bad Request")
+access_log = AccessLog()
+
+# --- Profiling ---
+def add_phase(name, since):
+    """Adds the time since `since` to a phase of the request this thread is preparing (--profile only)."""
+    if not PROFILE:
+        return
+    phases = getattr(_profile_local, 'phases', None)
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - since
+
+class Profiler:
+    """
+    --profile mode. A sample of requests is prepared under cProfile and the
+    results are added up in one pstats.Stats, which a background thread dumps
+    every PROFILE_DUMP_INTERVAL seconds. One request is profiled at a time:
+    newer Pythons allow only one active profiler, and samples add up all the
+    same. Also keeps the phase timings and logs slow requests.
+    """
+
+    def __init__(self):
+        self.stats = None
+        self.samples = 0
+        self.dumped = 0
+        self.lock = threading.Lock()
+        self.profiling = threading.Lock()
+        self.stopped = threading.Event()
+
+    def output_path(self, suffix):
+        if _worker_counters is not None:
+            return f"{PROFILE_OUTPUT}.w{_worker_slot + 1}{suffix}"
+        return PROFILE_OUTPUT + suffix
+
+    def start(self):
+        if TRACEMALLOC:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        if PROFILE:
+            threading.Thread(target=self.run, name='profiler', daemon=True).start()
+            log('info', f"🔬 Profiling {PROFILE_SAMPLE_RATE:.0%} of orders into {self.output_path('.pstats')}")
+
+    def stop(self):
+        self.stopped.set()
+        if PROFILE and self.dump():
+            log('info', f"🔬 Profile of {self.samples} orders: {self.output_path('.pstats')}")
+        if tracemalloc.is_tracing():
+            self.write_snapshot()
+
+    def run(self):
+        while not self.stopped.wait(PROFILE_DUMP_INTERVAL):
+            self.dump()
+
+    def dump(self):
+        """Writes the stats gathered so far, if there are new ones. Returns whether there are any."""
+        with self.lock:
+            if self.stats is None:
+                return False
+            if self.samples != self.dumped:
+                path = self.output_path('.pstats')
+                self.stats.dump_stats(path + '.tmp')
+                os.replace(path + '.tmp', path)
+                self.dumped = self.samples
+            return True
+
+    def write_snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        path = self.output_path('.tracemalloc')
+        snapshot.dump(path)
+        statistics = snapshot.statistics('lineno')
+        traced = sum(statistic.size for statistic in statistics)
+        log('info', f"🧠 Memory snapshot ({traced / (1024 * 1024):.1f} MB traced): {path}")
+        for statistic in statistics[:5]:
+            log('info', f"   {statistic}")
+
+    def prepare(self, request):
+        """prepare_response() with its phases timed, under cProfile for a sample of requests."""
+        _profile_local.phases = request.phases
+        try:
+            if random.random() >= PROFILE_SAMPLE_RATE or not self.profiling.acquire(blocking=False):
+                return prepare_response(request)
+            try:
+                profile = cProfile.Profile()
+                response = profile.runcall(prepare_response, request)
+            finally:
+                self.profiling.release()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+                self.samples += 1
+            return response
+        finally:
+            _profile_local.phases = None
+
+    def finish(self, request, response, started, prepared):
+        """Records the phases of a request that has been sent, and logs it if it was slow."""
+        finished = time.perf_counter()
+        phases = request.phases
+        if phases is None:
             return
+        phases['send'] = finished - prepared
+        shard = metrics_shard()
+        for name, seconds in phases.items():
+            shard.phase_seconds[name] += seconds
+        total = phases.get('parse', 0.0) + finished - started
+        if total >= SLOW_REQUEST_THRESHOLD:
+            breakdown = ", ".join(f"{name} {seconds * 1000:.1f}" for name, seconds in phases.items())
+            log('warning', f"🐢 Slow dish: {request.method} {request.target} ({response.status_code}) "
+                           f"took {total * 1000:.1f} ms: {breakdown} ms")
 
-        method, path, http_version = parts[0], parts[1], parts[2]
+profiler = Profiler()
 
-        print(f"👨‍🍳 Request: {method} {path} {http_version}")
+# --- Slow Clients ---
+class Connection:
+    """A client connection as the reaper sees it: the phase it is in and until when that may last."""
+    __slots__ = ('ip', 'phase', 'deadline', 'abort', 'bandwidth')
 
-        if method == 'GET':
-            if '..' in path or path.startswith('/.') or path.endswith('/.'):
-                send_error(client_socket, 403, "Forbidden")
-                return
+    def __init__(self, ip, abort):
+        self.ip = ip
+        self.abort = abort
+        self.bandwidth = Throttle(CONNECTION_BANDWIDTH) if CONNECTION_BANDWIDTH else None
+        self.wait('header', HEADER_TIMEOUT)
 
-            if path == '/':
-                requested_file_relative = 'index.html'
-                requested_dir_absolute = WEB_ROOT
-            else:
-                requested_file_relative = path[1:]
-                requested_dir_absolute = os.path.join(WEB_ROOT, os.path.dirname(requested_file_relative))
+    def wait(self, phase, timeout):
+        """Starts (or extends) a phase the client must finish within `timeout` seconds."""
+        self.phase = phase
+        self.deadline = time.monotonic() + timeout
+
+    def busy(self):
+        """The kitchen is working on this connection; no deadline."""
+        self.deadline = None
+
+class ConnectionTracker:
+    """
+    Admits connections up to the global and per-IP caps and keeps the open
+    ones in a set for the reaper. Handlers only set attributes on their
+    Connection; the reaper thread looks for deadlines that have passed and
+    aborts those connections, which wakes up whoever is blocked on them.
+    """
+
+    def __init__(self, max_connections, max_per_ip):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.connections = set()
+        self.per_ip = collections.Counter()
+        self.reaped = collections.Counter()
+        self.lock = threading.Lock()
+        self.reaper = None
 
-            requested_file_absolute = os.path.join(WEB_ROOT, requested_file_relative)
+    def open(self, ip, abort):
+        """Returns (Connection, None), or (None, reason) if a cap is reached."""
+        with self.lock:
+            if len(self.connections) >= self.max_connections:
+                return None, 'max_connections'
+            if self.per_ip[ip] >= self.max_per_ip:
+                return None, 'per_ip'
+            connection = Connection(ip, abort)
+            self.connections.add(connection)
+            self.per_ip[ip] += 1
+        return connection, None
 
-            if os.path.isdir(requested_file_absolute):
-                requested_file_absolute = os.path.join(requested_file_absolute, 'index.html')
-                requested_dir_absolute = os.path.dirname(requested_file_absolute)
+    def close(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+                self.per_ip[connection.ip] -= 1
+                if not self.per_ip[connection.ip]:
+                    del self.per_ip[connection.ip]
 
-            if os.path.exists(requested_file_absolute) and os.path.isfile(requested_file_absolute):
-                mime_type = get_mime_type(requested_file_absolute)
-                send_response(client_socket, 200, "OK", mime_type, requested_file_absolute)
+    def start_reaper(self):
+        if self.reaper is None:
+            self.reaper = threading.Thread(target=self.run_reaper, name='reaper', daemon=True)
+            self.reaper.start()
+
+    def run_reaper(self):
+        while True:
+            time.sleep(REAPER_INTERVAL)
+            self.reap()
+
+    def reap(self):
+        """Aborts every connection that is past its deadline."""
+        now = time.monotonic()
+        with self.lock:
+            expired = [c for c in self.connections if c.deadline is not None and c.deadline <= now]
+        for connection in expired:
+            phase = connection.phase
+            connection.busy()
+            self.reaped[phase] += 1
+            try:
+                connection.abort()
+            except (OSError, RuntimeError):
+                # Already closed, or the event loop it belonged to is gone
+                pass
+            if phase != 'idle':
+                log('debug', f"🐌 Showed a slow customer from {connection.ip} out ({phase} took too long)")
+
+connection_tracker = ConnectionTracker(MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP)
+
+# --- Rate Limits ---
+class RateLimiter:
+    """
+    Per-IP token buckets for requests. A bucket is just a (tokens, stamp)
+    pair, kept in an OrderedDict in least-recently-used order. Buckets that
+    have filled up again are no different from a fresh one and are dropped,
+    and beyond max_clients the least recently seen IPs are forgotten.
+    """
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        self.buckets = collections.OrderedDict()
+        self.limited = 0
+        self.lock = threading.Lock()
+
+    def admit(self, ip):
+        """Takes a token for `ip`. Returns 0.0 if the request may go ahead, else seconds until it could."""
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.pop(ip, None)
+            if bucket is None:
+                tokens = self.burst
             else:
-                print(f"Ingredient not found: {requested_file_absolute}")
-                send_error(client_socket, 404, "Not Found")
-        else:
-            send_error(client_socket, 501, "Not Implemented")
-    except ConnectionResetError:
-        print("Client left the kitchen unexpectedly. 💔")
-    except Exception as e:
-        print(f"Oops! A kitchen mishap: {e}")
-        send_error(client_socket, 500, "Internal Server Error")
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate
+                self.limited += 1
+            self.buckets[ip] = (tokens, now)
+            self.expire(now)
+        return wait
+
+    def expire(self, now):
+        buckets = self.buckets
+        while len(buckets) > self.max_clients:
+            buckets.popitem(last=False)
+        while buckets:
+            ip, (tokens, stamp) = next(iter(buckets.items()))
+            if stamp + (self.burst - tokens) / self.rate > now:
+                break
+            del buckets[ip]
+
+class Throttle:
+    """
+    A bytes-per-second token bucket that may run into debt: take() always
+    succeeds and says how long to wait before sending, so callers queue up
+    in order. A quarter second's worth may go out without waiting.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'lock')
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = rate / 4
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - amount
+            self.stamp = now
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+rate_limiter = RateLimiter(RATE_LIMIT_REQUESTS, RATE_LIMIT_BURST, RATE_LIMIT_CLIENTS)
+total_bandwidth = Throttle(TOTAL_BANDWIDTH) if TOTAL_BANDWIDTH else None
+
+def rate_limited_response(request, wait):
+    """Builds the 429 for a client that is over its request rate."""
+    response = error_response(429, "Too Many Requests")
+    response.headers.append(('Retry-After', str(int(wait) + 1)))
+    response.keep_alive = wants_keep_alive(request)
+    log('debug', f"🚦 Asked a hasty customer to wait {wait:.1f}s (429)")
+    return response
+
+def throttled(connection):
+    return connection.bandwidth is not None or total_bandwidth is not None
+
+def bandwidth_delay(connection, amount):
+    """Seconds to wait before sending `amount` more bytes under the bandwidth caps."""
+    delay = 0.0
+    if connection.bandwidth is not None:
+        delay = connection.bandwidth.take(amount)
+    if total_bandwidth is not None:
+        delay = max(delay, total_bandwidth.take(amount))
+    if delay:
+        metrics_shard().throttled_seconds += delay
+        # Time spent waiting on our own caps doesn't count against the client
+        connection.wait('send', SEND_TIMEOUT + delay)
+    return delay
+
+def pace(connection, amount):
+    """Sleeps as long as the bandwidth caps require before sending `amount` bytes."""
+    delay = bandwidth_delay(connection, amount)
+    if delay:
+        time.sleep(delay)
+
+def wait_for_request(connection, parser, idle):
+    """
+    Sets the deadline for the next request: KEEPALIVE_TIMEOUT until a kept-alive
+    client starts talking again, HEADER_TIMEOUT once it has (or on a new connection).
+    """
+    if idle and not parser.buffer and parser.pending is None:
+        connection.wait('idle', KEEPALIVE_TIMEOUT)
+    elif connection.phase != 'header' or connection.deadline is None:
+        connection.wait('header', HEADER_TIMEOUT)
+
+def linger(guest):
+    """
+    Gives a kept-alive client KEEPALIVE_LINGER seconds to send more. Returns
+    True if something arrived and was fed to the parser.
+    """
+    guest.socket.settimeout(KEEPALIVE_LINGER)
+    try:
+        data = guest.socket.recv(RECV_SIZE)
+    except socket.timeout:
+        return False
     finally:
-        client_socket.close()
-        with request_count_lock:
-            request_count += 1
+        guest.socket.settimeout(None)
+    # An empty read means the client hung up; the waiting room sees that too
+    guest.parser.feed(data)
+    return bool(data)
 
-def send_response(client_socket, status_code, status_message, content_type, file_path):
-    """Sends an HTTP response with file content."""
+def handle_request(guest, request):
+    """
+    Serves `request` and any complete requests pipelined behind it. Returns
+    True if the connection stays open for the next one.
+    """
+    client_socket, client_address, connection = guest.socket, guest.address, guest.connection
+    response = None
     try:
-        with open(file_path, 'rb') as f:
-            content = f.read()
-
-        headers = [
-            f"HTTP/1.1 {status_code} {status_message}",
-            f"Content-Type: {content_type}",
-            f"Content-Length: {len(content)}",
-            "Connection: close",
-            "\r\n"
-        ]
-        response_headers = "\r\n".join(headers).encode('utf-8')
+        while request is not None:
+            started = time.perf_counter()
+            wait = rate_limiter.admit(client_address[0])
+            if wait:
+                response = rate_limited_response(request, wait)
+            elif PROFILE:
+                response = profiler.prepare(request)
+            else:
+                response = prepare_response(request)
+            prepared = time.perf_counter()
+            guest.requests_served += 1
+            if guest.requests_served >= MAX_KEEPALIVE_REQUESTS:
+                response.keep_alive = False
+            count_request()
 
-        client_socket.sendall(response_headers)
-        client_socket.sendall(content)
-        print(f"✅ Dish served: {status_code} {status_message} for {os.path.basename(file_path)}")
-    except FileNotFoundError:
-        print(f"Error: Ingredient missing when preparing dish: {file_path}")
-        send_error(client_socket, 404, "Not Found")
+            send_response(client_socket, response, connection)
+            record_request(request.method, response, started, prepared)
+            if PROFILE:
+                profiler.finish(request, response, started, prepared)
+            access_log.record(client_address, request, response.status_code,
+                              response.content_length, started)
+            if not response.keep_alive:
+                return False
+            response = None
+            request = guest.parser.next_request()
+            if request is None and linger(guest):
+                request = guest.parser.next_request()
+        return True
+    except RequestError as e:
+        access_log.record(client_address, None, e.status_code, 0, time.perf_counter())
+        send_error(client_socket, e.status_code, e.status_message, connection)
+    except ConnectionError:
+        log('debug', "Client left the kitchen unexpectedly. 💔")
     except Exception as e:
-        print(f"Error serving the dish for {file_path}: {e}")
-        send_error(client_socket, 500, "Internal Server Error")
+        log('warning', f"Oops! A kitchen mishap: {e}")
+        if response is None or not response.head_sent:
+            send_error(client_socket, 500, "Internal Server Error", connection)
+    return False
+
+def send_response(client_socket, response, connection):
+    """Sends a prepared Response, streaming file bodies from disk."""
+    connection.wait('send', SEND_TIMEOUT)
+    response.head_sent = True
+    try:
+        if response.chunks is not None:
+            send_chunks(client_socket, response, connection)
+        elif response.file is None:
+            if len(response.body) > SEND_CHUNK_SIZE:
+                # Large bodies (site pack slices among them) aren't copied behind the headers
+                send_bytes(client_socket, response.head(), connection)
+                send_bytes(client_socket, response.body, connection)
+            else:
+                send_bytes(client_socket, response.head() + response.body, connection)
+        else:
+            # Pending bytes (headers, multipart boundaries) go out in one
+            # syscall together with the first slice of the next file
+            # segment; small files are done after that.
+            pending = response.head()
+            for segment in response.segments:
+                if isinstance(segment, bytes):
+                    pending += segment
+                    continue
+                offset, count = segment
+                first_chunk = read_file_slice(response.file, offset, min(SEND_CHUNK_SIZE, count))
+                send_bytes(client_socket, pending + first_chunk, connection)
+                pending = b''
+                missing = send_file_body(client_socket, response.file, offset + len(first_chunk),
+                                         count - len(first_chunk), connection)
+                if missing:
+                    body_cut_short(response, missing)
+                    return
+            if pending:
+                send_bytes(client_socket, pending, connection)
+    finally:
+        response.close()
+
+    log_served(response)
+
+def send_bytes(client_socket, data, connection):
+    """
+    sendall() in slices: every SEND_SLICE_SIZE bytes the client has taken earn
+    it more time, like file bodies, and slices are paced while a bandwidth
+    cap is on.
+    """
+    slice_size = BANDWIDTH_SLICE_SIZE if throttled(connection) else SEND_SLICE_SIZE
+    if len(data) <= slice_size:
+        pace(connection, len(data))
+        client_socket.sendall(data)
+        return
+    data = memoryview(data)
+    for start in range(0, len(data), slice_size):
+        piece = data[start:start + slice_size]
+        connection.wait('send', SEND_TIMEOUT)
+        pace(connection, len(piece))
+        client_socket.sendall(piece)
+
+def frame_chunk(response, chunk):
+    """Counts a streamed chunk and adds chunked framing where it is used."""
+    response.content_length += len(chunk)
+    if not response.chunked:
+        return chunk
+    return b"%x\r\n%s\r\n" % (len(chunk), chunk)
+
+def send_chunks(client_socket, response, connection):
+    """Sends a generated body as it is produced, one chunk at a time."""
+    pending = response.head()
+    for chunk in response.chunks:
+        if chunk:
+            send_bytes(client_socket, pending + frame_chunk(response, chunk), connection)
+            pending = b''
+            connection.wait('send', SEND_TIMEOUT)
+    send_bytes(client_socket, pending + (_LAST_CHUNK if response.chunked else b''), connection)
+
+def body_cut_short(response, missing):
+    """
+    The file shrank after the headers promised its full length. Only closing
+    the connection tells the client; anything sent after would be misread.
+    """
+    response.keep_alive = False
+    response.content_length -= missing
+    log('warning', f"✂️ {response.description} came up {missing} bytes short; the file shrank while serving")
+
+def log_served(response):
+    if response.status_code >= 400:
+        log('debug', f"❌ Sent error {response.description}")
+    else:
+        log('debug', f"✅ Dish served: {response.description}")
+
+def read_file_slice(f, offset, count):
+    """Reads up to `count` bytes of an open file starting at `offset`."""
+    f.seek(offset)
+    return f.read(count)
+
+def send_file_body(client_socket, f, offset, count, connection):
+    """
+    Sends `count` bytes of an open file starting at `offset`.
+    Uses zero-copy sendfile where available and falls back to reading the
+    file in fixed-size chunks, so memory per connection stays constant.
+    Every SEND_SLICE_SIZE bytes the client has taken earn it more time.
+    Returns how many bytes are missing if the file ended early.
+    """
+    if count <= 0:
+        return 0
 
-def send_error(client_socket, status_code, status_message):
+    if USE_SENDFILE:
+        # The socket is blocking, so each call returns once some of the slice is out
+        out_fd, in_fd = client_socket.fileno(), f.fileno()
+        slice_size = BANDWIDTH_SLICE_SIZE if throttled(connection) else SEND_SLICE_SIZE
+        while count > 0:
+            connection.wait('send', SEND_TIMEOUT)
+            size = min(slice_size, count)
+            pace(connection, size)
+            sent = os.sendfile(out_fd, in_fd, offset, size)
+            if not sent:
+                break
+            offset += sent
+            count -= sent
+        return count
+
+    f.seek(offset)
+    buffer = memoryview(bytearray(SEND_CHUNK_SIZE))
+    remaining = count
+    while remaining > 0:
+        read = f.readinto(buffer[:min(SEND_CHUNK_SIZE, remaining)])
+        if not read:
+            break
+        connection.wait('send', SEND_TIMEOUT)
+        send_bytes(client_socket, buffer[:read], connection)
+        remaining -= read
+    return remaining
+
+def send_error(client_socket, status_code, status_message, connection):
     """Sends an HTTP error response with a kitchen-themed error page."""
+    try:
+        send_response(client_socket, error_response(status_code, status_message), connection)
+    except Exception as e:
+        log('debug', f"Failed to send error response: {e}")
+    finally:
+        client_socket.close()
+
+def error_response(status_code, status_message):
+    """Builds a Response carrying the kitchen-themed error page."""
+    response = Response(status_code, status_message, "text/html; charset=utf-8",
+                        body=build_error_page(status_code, status_message))
+    response.headers.append(('Vary', 'Accept-Encoding'))
+    return response
+
+@functools.lru_cache(maxsize=32)
+def build_error_page(status_code, status_message):
+    """Renders the kitchen-themed error page as bytes."""
     error_content = f"""
     <!DOCTYPE html>
     <html lang="en">
@@ -176,48 +1982,734 @@ def send_error(client_socket, status_code, status_message):
     </html>
     """.strip()
 
-    error_content_bytes = error_content.encode('utf-8')
+    return error_content.encode('utf-8')
 
-    headers = [
-        f"HTTP/1.1 {status_code} {status_message}",
-        "Content-Type: text/html; charset=utf-8",
-        f"Content-Length: {len(error_content_bytes)}",
-        "Connection: close",
-        "\r\n"
-    ]
-    response_headers = "\r\n".join(headers).encode('utf-8')
+# --- Asyncio Engine ---
+async def handle_request_async(reader, writer):
+    """Asyncio counterpart of handle_request; disk work runs in the executor."""
+    loop = asyncio.get_event_loop()
+    client_address = writer.get_extra_info('peername')
+    log('debug', f"Customer arrived from {client_address[0]}:{client_address[1]} 🚶")
+    # Cancelling the task (rather than aborting the transport) also cleanly
+    # interrupts a loop.sendfile() in progress
+    task = asyncio.current_task()
+    connection, reason = connection_tracker.open(
+        client_address[0], lambda: loop.call_soon_threadsafe(task.cancel))
+    if connection is None:
+        reject_busy_async(writer, reason)
+        return
 
+    parser = RequestParser()
+    requests_served = 0
+    shard = metrics_shard()
+    shard.open_connections += 1
     try:
-        client_socket.sendall(response_headers)
-        client_socket.sendall(error_content_bytes)
-        print(f"❌ Sent error {status_code} {status_message}")
+        while True:
+            response = None
+            request = parser.next_request()
+            if request is None:
+                wait_for_request(connection, parser, idle=requests_served > 0)
+            while request is None:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    return
+                if connection.phase == 'idle':
+                    connection.wait('header', HEADER_TIMEOUT)
+                parser.feed(data)
+                request = parser.next_request()
+            connection.busy()
+
+            started = time.perf_counter()
+            wait = rate_limiter.admit(client_address[0])
+            if wait:
+                response = rate_limited_response(request, wait)
+            else:
+                response = await loop.run_in_executor(
+                    None, profiler.prepare if PROFILE else prepare_response, request)
+            prepared = time.perf_counter()
+            requests_served += 1
+            if requests_served >= MAX_KEEPALIVE_REQUESTS:
+                response.keep_alive = False
+            count_request()
+
+            await send_response_async(writer, response, connection)
+            record_request(request.method, response, started, prepared)
+            if PROFILE:
+                profiler.finish(request, response, started, prepared)
+            access_log.record(client_address, request, response.status_code,
+                              response.content_length, started)
+            if not response.keep_alive:
+                return
+    except asyncio.CancelledError:
+        # Reaped, or the kitchen is closing; either way this customer is done,
+        # and whatever is still buffered for them is dropped
+        writer.transport.abort()
+    except RequestError as e:
+        access_log.record(client_address, None, e.status_code, 0, time.perf_counter())
+        await send_response_async(writer, error_response(e.status_code, e.status_message), connection)
+    except ConnectionError:
+        log('debug', "Client left the kitchen unexpectedly. 💔")
     except Exception as e:
-        print(f"Failed to send error response: {e}")
+        log('warning', f"Oops! A kitchen mishap: {e}")
+        if response is not None and response.head_sent:
+            return
+        try:
+            await send_response_async(writer, error_response(500, "Internal Server Error"), connection)
+        except Exception as e:
+            log('debug', f"Failed to send error response: {e}")
+    finally:
+        shard.open_connections -= 1
+        connection_tracker.close(connection)
+        writer.close()
+
+def reject_busy_async(writer, reason):
+    """Asyncio counterpart of reject_busy."""
+    writer.write(_BUSY_RESPONSE)
+    writer.close()
+    metrics_shard().rejected_connections[reason] += 1
+    log('debug', f"🚫 Kitchen is full, turned a customer away (503, {reason})")
+
+async def send_response_async(writer, response, connection):
+    """Sends a prepared Response over an asyncio stream."""
+    loop = asyncio.get_event_loop()
+    connection.wait('send', SEND_TIMEOUT)
+    response.head_sent = True
+    try:
+        if response.chunks is not None:
+            await send_chunks_async(writer, response, connection)
+        elif response.file is None:
+            if len(response.body) > SEND_CHUNK_SIZE:
+                writer.write(response.head())
+                await write_async(writer, response.body, connection)
+            else:
+                await write_async(writer, response.head() + response.body, connection)
+        else:
+            pending = response.head()
+            for segment in response.segments:
+                if isinstance(segment, bytes):
+                    pending += segment
+                    continue
+                offset, count = segment
+                first_chunk = await loop.run_in_executor(
+                    None, read_file_slice, response.file, offset, min(SEND_CHUNK_SIZE, count))
+                await write_async(writer, pending + first_chunk, connection)
+                pending = b''
+                missing = await send_file_body_async(writer, response.file, offset + len(first_chunk),
+                                                     count - len(first_chunk), connection)
+                if missing:
+                    body_cut_short(response, missing)
+                    return
+            if pending:
+                await write_async(writer, pending, connection)
+    finally:
+        response.close()
+
+    log_served(response)
+
+async def write_async(writer, data, connection):
+    """Asyncio counterpart of send_bytes."""
+    slice_size = BANDWIDTH_SLICE_SIZE if throttled(connection) else SEND_SLICE_SIZE
+    if len(data) <= slice_size and not throttled(connection):
+        writer.write(data)
+        await writer.drain()
+        return
+    data = memoryview(data)
+    for start in range(0, len(data), slice_size):
+        piece = data[start:start + slice_size]
+        connection.wait('send', SEND_TIMEOUT)
+        delay = bandwidth_delay(connection, len(piece))
+        if delay:
+            await asyncio.sleep(delay)
+        writer.write(piece)
+        await writer.drain()
+
+async def send_chunks_async(writer, response, connection):
+    """Sends a generated body; producing each chunk may touch the disk, so it runs in the executor."""
+    loop = asyncio.get_event_loop()
+    pending = response.head()
+    while True:
+        step = loop.run_in_executor(None, next, response.chunks, None)
+        try:
+            chunk = await asyncio.shield(step)
+        except asyncio.CancelledError:
+            # The generator is still running in the executor and can't be
+            # closed before that step is over, so leave closing it to then
+            chunks, response.chunks = response.chunks, None
+            if hasattr(chunks, 'close'):
+                step.add_done_callback(lambda _: chunks.close())
+            raise
+        if chunk is None:
+            break
+        if chunk:
+            await write_async(writer, pending + frame_chunk(response, chunk), connection)
+            pending = b''
+            connection.wait('send', SEND_TIMEOUT)
+    await write_async(writer, pending + (_LAST_CHUNK if response.chunked else b''), connection)
+
+async def send_file_body_async(writer, f, offset, count, connection):
+    """Streams part of a file with loop.sendfile, or chunked executor reads. Returns the bytes missing at EOF."""
+    if count <= 0:
+        return 0
+
+    loop = asyncio.get_event_loop()
+    if hasattr(loop, 'sendfile'):
+        slice_size = BANDWIDTH_SLICE_SIZE if throttled(connection) else SEND_SLICE_SIZE
+        while count > 0:
+            connection.wait('send', SEND_TIMEOUT)
+            size = min(slice_size, count)
+            delay = bandwidth_delay(connection, size)
+            if delay:
+                await asyncio.sleep(delay)
+            sent = await loop.sendfile(writer.transport, f, offset, size)
+            if not sent:
+                break
+            offset += sent
+            count -= sent
+        return count
+
+    f.seek(offset)
+    remaining = count
+    while remaining > 0:
+        chunk = await loop.run_in_executor(None, f.read, min(SEND_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        connection.wait('send', SEND_TIMEOUT)
+        await write_async(writer, chunk, connection)
+        remaining -= len(chunk)
+    return remaining
+
+def serve(server_socket):
+    """Runs the configured engine on a listening socket until interrupted."""
+    # Started here rather than in main() so every worker process gets its own writer
+    access_log.start(ACCESS_LOG, ACCESS_LOG_FORMAT, ACCESS_LOG_SAMPLE_RATE)
+    connection_tracker.start_reaper()
+    profiler.start()
+    try:
+        if ENGINE == 'asyncio':
+            serve_asyncio(server_socket)
+        else:
+            serve_threaded(server_socket)
+    finally:
+        profiler.stop()
+        access_log.stop()
+
+def serve_asyncio(server_socket):
+    """Runs the asyncio engine on an already listening socket until interrupted."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(
+        max_workers=ASYNC_EXECUTOR_THREADS, thread_name_prefix='cook'))
+
+    server = loop.run_until_complete(asyncio.start_server(
+        handle_request_async, sock=server_socket, backlog=LISTEN_BACKLOG))
+    log('info', f"👨‍🍳 One event loop on duty, {ASYNC_EXECUTOR_THREADS} helpers for the pantry")
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        # Don't wait for kept-alive customers to leave on their own
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+
+# --- Threaded Engine ---
+def serve_threaded(server_socket):
+    """Accepts connections and hands them to the worker pool until interrupted."""
+    global _connection_queue
+    connection_queue = _connection_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    waiting_room = WaitingRoom(connection_queue)
+    start_worker_pool(connection_queue, waiting_room, WORKER_THREADS)
+    log('info', f"👨‍🍳 {WORKER_THREADS} cooks on duty, room for {QUEUE_SIZE} waiting orders")
+    waiting_room.run(server_socket)
+
+class Guest:
+    """A connection of the threaded engine and what has been read from it."""
+    __slots__ = ('socket', 'address', 'connection', 'parser', 'requests_served')
+
+    def __init__(self, client_socket, client_address, connection):
+        self.socket = client_socket
+        self.address = client_address
+        self.connection = connection
+        self.parser = RequestParser()
+        self.requests_served = 0
+
+class WaitingRoom:
+    """
+    Holds the threaded engine's connections while they have no complete
+    request: new ones still sending their head, and kept-alive ones between
+    requests. The accepting thread reads them all through one selector and
+    only queues a connection for a cook once a request is ready, so slow or
+    idle clients never tie up the worker pool. Cooks hand kept-alive
+    connections back with park(); the reaper's shutdown() of an overdue
+    connection shows up here as end of file.
+    """
+
+    def __init__(self, connection_queue):
+        self.connection_queue = connection_queue
+        self.selector = selectors.DefaultSelector()
+        self.returning = collections.deque()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def run(self, server_socket):
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is server_socket:
+                    self.accept(server_socket)
+                elif key.fileobj is self.wakeup_reader:
+                    self.seat_returning()
+                else:
+                    self.read(key.data)
+
+    def accept(self, server_socket):
+        try:
+            client_socket, client_address = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            # Another worker process took it
+            return
+        log('debug', f"Customer arrived from {client_address[0]}:{client_address[1]} 🚶")
+        connection, reason = connection_tracker.open(
+            client_address[0], functools.partial(client_socket.shutdown, socket.SHUT_RDWR))
+        if connection is None:
+            reject_busy(client_socket, reason)
+            return
+        metrics_shard().open_connections += 1
+        client_socket.setblocking(False)
+        guest = Guest(client_socket, client_address, connection)
+        self.selector.register(client_socket, selectors.EVENT_READ, guest)
+
+    def read(self, guest):
+        try:
+            data = guest.socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.selector.unregister(guest.socket)
+            self.close(guest)
+            return
+        connection = guest.connection
+        if connection.phase == 'idle':
+            connection.wait('header', HEADER_TIMEOUT)
+        guest.parser.feed(data)
+        try:
+            request = guest.parser.next_request()
+        except RequestError as e:
+            self.selector.unregister(guest.socket)
+            access_log.record(guest.address, None, e.status_code, 0, time.perf_counter())
+            response = error_response(e.status_code, e.status_message)
+            self.turn_away(guest, response.head() + response.body)
+            return
+        if request is None:
+            return
+
+        self.selector.unregister(guest.socket)
+        connection.busy()
+        guest.socket.setblocking(True)
+        try:
+            self.connection_queue.put_nowait((guest, request))
+        except queue.Full:
+            metrics_shard().rejected_connections['queue_full'] += 1
+            log('debug', "🚫 Kitchen is full, turned a customer away (503, queue_full)")
+            self.turn_away(guest, _BUSY_RESPONSE)
+
+    def turn_away(self, guest, data):
+        """Sends a short final response without blocking and closes the connection."""
+        try:
+            guest.socket.setblocking(False)
+            guest.socket.send(data)
+        except OSError:
+            pass
+        self.close(guest)
+
+    def park(self, guest):
+        """Takes a kept-alive connection back from a cook (any thread)."""
+        wait_for_request(guest.connection, guest.parser, idle=True)
+        self.returning.append(guest)
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            # A wakeup is pending already
+            pass
+
+    def seat_returning(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.returning:
+            guest = self.returning.popleft()
+            try:
+                guest.socket.setblocking(False)
+                self.selector.register(guest.socket, selectors.EVENT_READ, guest)
+            except (OSError, ValueError):
+                self.close(guest)
+
+    def close(self, guest):
+        connection_tracker.close(guest.connection)
+        metrics_shard().open_connections -= 1
+        guest.socket.close()
+
+# --- Worker Processes ---
+def serve_workers(server_socket, workers, reuse_port):
+    """
+    Forks `workers` processes that each run the engine, restarts any that
+    die, and stops them all on Ctrl+C. Per-worker receipt counters live in
+    a shared memory block and are added up for the receipt. Request counts
+    are written as they happen; the other metrics when a worker shuts down.
+    """
+    global request_count, _receipt_totals
+    counters = memoryview(mmap.mmap(-1, 8 * RECEIPT_FIELDS * workers)).cast('q')
+    children = {}
+
+    for slot in range(workers):
+        pid = spawn_worker(slot, server_socket, counters, reuse_port)
+        children[pid] = slot
+    log('info', f"👨‍🍳 {workers} kitchen stations open (pids {', '.join(map(str, children))})")
+
+    try:
+        while True:
+            pid, status = os.wait()
+            slot = children.pop(pid, None)
+            if slot is None:
+                continue
+            log('warning', f"💥 Station {slot + 1} (pid {pid}) closed unexpectedly, opening a replacement...")
+            time.sleep(WORKER_RESTART_DELAY)
+            children[spawn_worker(slot, server_socket, counters, reuse_port)] = slot
+    finally:
+        stop_workers(children)
+        _receipt_totals = [sum(counters[field::RECEIPT_FIELDS]) for field in range(RECEIPT_FIELDS)]
+        request_count = _receipt_totals[0]
+
+def spawn_worker(slot, server_socket, counters, reuse_port):
+    """Forks one worker process for `slot` and returns its pid."""
+    # Anything still buffered would otherwise be printed by parent and child
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+
+    global _worker_counters, _worker_slot, _worker_base
+    exit_code = 0
+    try:
+        _worker_counters = counters
+        _worker_slot = slot
+        _worker_base = list(counters[slot * RECEIPT_FIELDS:(slot + 1) * RECEIPT_FIELDS])
+        if reuse_port:
+            # The parent's socket is only bound to hold the port; every worker
+            # listens on its own and the kernel spreads connections across them
+            server_socket.close()
+            server_socket = create_server_socket(reuse_port=True)
+            server_socket.listen(LISTEN_BACKLOG)
+        serve(server_socket)
+    except KeyboardInterrupt:
+        pass
+    except BaseException as e:
+        log('warning', f"🚨 Station {slot + 1} caught fire: {e}")
+        exit_code = 1
+    finally:
+        if _worker_base is not None:
+            own = receipt_vector(metrics_totals())
+            for field in range(1, RECEIPT_FIELDS):
+                counters[slot * RECEIPT_FIELDS + field] = _worker_base[field] + own[field]
+        sys.stdout.flush()
+        os._exit(exit_code)
+
+def stop_workers(children):
+    """Asks every worker to finish, and forces the ones that won't."""
+    # A second Ctrl+C must not cut the shutdown short and orphan workers
+    previous_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+    while children and time.monotonic() < deadline:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            # Everyone is gone, including any we reaped but hadn't crossed off
+            children.clear()
+            break
+        if pid:
+            children.pop(pid, None)
+        else:
+            time.sleep(0.05)
+
+    for pid in children:
+        log('warning', f"Station with pid {pid} did not close in time, forcing it. 🔨")
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+    children.clear()
+    signal.signal(signal.SIGINT, previous_handler)
+
+def worker_loop(connection_queue, waiting_room):
+    """Serves connections with a request ready off the queue, forever."""
+    while True:
+        guest, request = connection_queue.get()
+        keep_open = False
+        try:
+            keep_open = handle_request(guest, request)
+        finally:
+            if keep_open:
+                waiting_room.park(guest)
+            else:
+                waiting_room.close(guest)
+            connection_queue.task_done()
+
+def start_worker_pool(connection_queue, waiting_room, size):
+    """Starts `size` daemon worker threads feeding from `connection_queue`."""
+    workers = []
+    for i in range(size):
+        worker = threading.Thread(target=worker_loop, args=(connection_queue, waiting_room),
+                                  name=f"cook-{i + 1}", daemon=True)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+def reject_busy(client_socket, reason):
+    """Turns a customer away with a 503 without ever blocking the accept loop."""
+    try:
+        client_socket.setblocking(False)
+        client_socket.send(_BUSY_RESPONSE)
+    except OSError:
+        pass
     finally:
         client_socket.close()
+    metrics_shard().rejected_connections[reason] += 1
+    log('debug', f"🚫 Kitchen is full, turned a customer away (503, {reason})")
+
+ListingOptions = collections.namedtuple('ListingOptions', 'sort order page per_page format')
+DEFAULT_LISTING = ListingOptions('name', 'asc', 1, LISTING_PAGE_SIZE, 'html')
+
+def parse_listing_query(query):
+    """Reads the listing view from a query string; unknown or bad values fall back to defaults."""
+    params = urllib.parse.parse_qs(query)
+
+    def choice(name, allowed, default):
+        value = params.get(name, [default])[-1].lower()
+        return value if value in allowed else default
+
+    def number(name, default, highest):
+        try:
+            return min(highest, max(1, int(params.get(name, [default])[-1])))
+        except ValueError:
+            return default
+
+    per_page = number('per_page', DEFAULT_LISTING.per_page, LISTING_MAX_PAGE_SIZE)
+    return ListingOptions(
+        choice('sort', ('name', 'size', 'mtime'), DEFAULT_LISTING.sort),
+        choice('order', ('asc', 'desc'), DEFAULT_LISTING.order),
+        number('page', DEFAULT_LISTING.page, last_listing_page(per_page)),
+        per_page,
+        choice('format', ('html', 'json'), DEFAULT_LISTING.format),
+    )
+
+def last_listing_page(per_page):
+    """The deepest page reachable without holding more than LISTING_MAX_DEPTH entries."""
+    return max(1, LISTING_MAX_DEPTH // per_page)
+
+def listing_query(listing, **changes):
+    """Builds the query string for another view, leaving out default values."""
+    listing = listing._replace(**changes)
+    params = [(name, value) for name, value, default in zip(listing._fields, listing, DEFAULT_LISTING)
+              if value != default]
+    return '?' + urllib.parse.urlencode(params) if params else './'
+
+def directory_response(dir_path, cache_key=None, st=None, listing=DEFAULT_LISTING):
+    """
+    Serves a generated listing for a directory without an index.html. The
+    page is streamed while the directory is read, so huge directories start
+    arriving right away. Listings are never written to disk; the default
+    view of a directory is kept in the content cache if it turns out small,
+    and the cache rechecks the directory's mtime so changes show up.
+
+    Validators come from the directory's own stat, which only changes when
+    entries come or go. Views showing or sorting by entry sizes and times
+    would go stale behind them, so those get no validators and `no-store`.
+    """
+    if st is None:
+        st = os.stat(dir_path)
+    content_type = 'application/json' if listing.format == 'json' else 'text/html; charset=utf-8'
+    response = Response(200, "OK", content_type)
+    response.description += f" for listing of {display_name(os.path.relpath(dir_path, WEB_ROOT))}"
+    if listing.format == 'json' or listing.sort != 'name':
+        response.headers.append(('Cache-Control', 'no-store'))
+    else:
+        variant = None if listing == DEFAULT_LISTING else f"{zlib.crc32(repr(listing).encode()):x}"
+        set_validators(response, st, dir_path, variant)
+    response.headers.append(('Vary', 'Accept-Encoding'))
+
+    chunks = stream_directory_listing(dir_path, listing)
+    if cache_key is not None and content_cache.max_bytes:
+        chunks = cache_listing(chunks, response, cache_key, dir_path, st)
+    response.chunks = chunks
+    return response
+
+def cache_listing(chunks, response, cache_key, dir_path, st):
+    """Passes a listing through and stores it whole in the content cache if it fits."""
+    collected = []
+    size = 0
+    for chunk in chunks:
+        if collected is not None:
+            size += len(chunk)
+            if content_cache.accepts(size):
+                collected.append(chunk)
+            else:
+                collected = None
+        yield chunk
+    if collected is not None:
+        cached = Response(200, "OK", response.content_type, body=b"".join(collected))
+        cached.description = response.description
+        cached.headers = list(response.headers)
+        cached.etag = response.etag
+        cached.last_modified = response.last_modified
+        content_cache.put(cache_key, dir_path, st, cached)
+
+def select_listing_entries(dir_path, listing):
+    """
+    Scans `dir_path` and returns (number of visible entries, DirEntry
+    objects on the requested page, in order). A heap keeps only the first
+    page * per_page entries in the requested order, never the whole directory.
+    """
+    total = 0
+
+    def visible_entries():
+        nonlocal total
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                # Exclude webchef.py itself and hidden files/folders (starting with '.')
+                if entry.name == os.path.basename(__file__) or entry.name.startswith('.'):
+                    continue
+                total += 1
+                yield entry
+
+    if listing.sort == 'name':
+        key = lambda entry: entry.name
+    else:
+        field = 'st_size' if listing.sort == 'size' else 'st_mtime_ns'
+
+        def key(entry):
+            try:
+                return getattr(entry.stat(), field), entry.name
+            except OSError:
+                return 0, entry.name
+
+    end = listing.page * listing.per_page
+    pick = heapq.nlargest if listing.order == 'desc' else heapq.nsmallest
+    page = pick(end, visible_entries(), key=key)[end - listing.per_page:]
+    return total, page
+
+def entry_kind(entry):
+    try:
+        if entry.is_dir():
+            return 'dir'
+        if entry.is_file():
+            return 'file'
+    except OSError:
+        pass
+    return 'other'
 
-def create_all_missing_index_htmls(root_dir):
+def stream_directory_listing(dir_path, listing):
     """
-    Creates default index.html files in the root directory and all subdirectories
-    if they don't already exist.
+    Yields a listing page as bytes in pieces of about LISTING_CHUNK_SIZE.
+    The top of the page is sent before the directory is even read.
     """
-    global _created_index_files
-    print("🧑‍🍳 Scanning directories for missing index.html files...")
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        index_path = os.path.join(dirpath, 'index.html')
-        if not os.path.exists(index_path):
-            relative_dir_display = os.path.relpath(dirpath, root_dir)
-            if relative_dir_display == '.':
-                relative_dir_display = './'
+    dir_path = os.path.normpath(dir_path)
+    root_dir = os.path.normpath(WEB_ROOT)
+    relative_dir = os.path.relpath(dir_path, root_dir)
+    url_path = '/' if relative_dir == '.' else '/' + relative_dir.replace(os.sep, '/') + '/'
 
-            print(f"🧑‍🍳 No index.html found in '{relative_dir_display}'. Whipping up a default one...")
-            default_content = f"""
+    if listing.format == 'json':
+        yield (json.dumps({'path': display_name(url_path), 'page': listing.page, 'per_page': listing.per_page,
+                           'sort': listing.sort, 'order': listing.order}, separators=(',', ':'))[:-1]
+               + ',"entries":[').encode('utf-8')
+    else:
+        yield listing_page_top(dir_path, root_dir, relative_dir, listing).encode('utf-8')
+
+    total, page = select_listing_entries(dir_path, listing)
+
+    parts = []
+    size = 0
+    for i, entry in enumerate(page):
+        kind = entry_kind(entry)
+        if listing.format == 'json':
+            item = {'name': display_name(entry.name), 'type': kind}
+            if kind == 'file':
+                try:
+                    entry_stat = entry.stat()
+                    item['size'] = entry_stat.st_size
+                    item['mtime'] = int(entry_stat.st_mtime)
+                except OSError:
+                    pass
+            part = (',' if i else '') + json.dumps(item, ensure_ascii=False, separators=(',', ':'))
+        else:
+            part = listing_row(entry.name, kind)
+        parts.append(part)
+        size += len(part)
+        if size >= LISTING_CHUNK_SIZE:
+            yield "".join(parts).encode('utf-8')
+            parts = []
+            size = 0
+
+    first = (listing.page - 1) * listing.per_page
+    has_next = first + len(page) < total and listing.page < last_listing_page(listing.per_page)
+    if listing.format == 'json':
+        next_page = (urllib.parse.quote(os.fsencode(url_path)) + listing_query(listing, page=listing.page + 1)
+                     if has_next else None)
+        parts.append(f'],"total":{total},"next":{json.dumps(next_page)}}}\n')
+    else:
+        parts.append(listing_page_bottom(listing, first, len(page), total, has_next))
+    yield "".join(parts).encode('utf-8')
+
+def listing_row(name, kind):
+    if kind == 'dir':
+        icon = "📁"
+        suffix = "/"
+    elif kind == 'file':
+        icon = "📄"
+        suffix = ""
+    else:
+        icon = "❓"
+        suffix = ""
+    # The link keeps the name's exact bytes, even if they aren't valid UTF-8
+    href_target = urllib.parse.quote(os.fsencode(name) + suffix.encode('ascii'))
+    link_text = display_name(name) + suffix
+    return f'<li><span class="icon">{icon}</span><a href="{href_target}">{html.escape(link_text)}</a></li>\n'
+
+def display_name(name):
+    """A file name as text; bytes that aren't valid UTF-8 show up as U+FFFD."""
+    return os.fsencode(name).decode('utf-8', 'replace')
+
+def listing_page_top(dir_path, root_dir, relative_dir, listing):
+    """Renders the default dark-themed index page up to the first entry."""
+    title_name = html.escape(display_name(os.path.basename(dir_path))) if dir_path != root_dir else 'Root'
+    relative_dir_display = html.escape('./' if relative_dir == '.' else display_name(relative_dir))
+    sort_links = " · ".join(
+        f'<strong>{label}</strong>' if listing.sort == sort else
+        f'<a href="{html.escape(listing_query(listing, sort=sort, page=1))}">{label}</a>'
+        for sort, label in (('name', 'name'), ('size', 'size'), ('mtime', 'date')))
+    top = f"""
             <!DOCTYPE html>
             <html lang="en">
             <head>
                 <meta charset="UTF-8">
                 <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>webchef.py - Index of {os.path.basename(dirpath) if dirpath != root_dir else 'Root'}</title>
+                <title>webchef.py - Index of {title_name}</title>
                 <style>
                     body {{
                         background-color: #333;
@@ -264,12 +2756,12 @@ def create_all_missing_index_htmls(root_dir):
                         justify-content: space-between;
                         box-shadow: 0 2px 4px rgba(0,0,0,0.2);
                     }}
-                    .directory-list li a {{
+                    .directory-list li a, .pager a {{
                         color: #bbb;
                         text-decoration: none;
                         font-weight: bold;
                     }}
-                    .directory-list li a:hover {{
+                    .directory-list li a:hover, .pager a:hover {{
                         text-decoration: underline;
                         color: #fff;
                     }}
@@ -278,6 +2770,10 @@ def create_all_missing_index_htmls(root_dir):
                         margin-right: 10px;
                         vertical-align: middle;
                     }}
+                    .pager {{
+                        font-size: 1em;
+                        color: #bbb;
+                    }}
                 </style>
             </head>
             <body>
@@ -285,99 +2781,552 @@ def create_all_missing_index_htmls(root_dir):
                     <h1>Welcome to your webchef.py Kitchen! 🧑‍🍳</h1>
                     <p>No <code>index.html</code> found here, so I've cooked up this default page for you.</p>
                     <p>Here's what's currently on the menu in <code>{relative_dir_display}</code>:</p>
+                    <p class="pager">Sort by {sort_links}</p>
                     <ul class="directory-list">
             """
-            # Add parent directory link if not the root directory
-            if dirpath != root_dir:
-                default_content += f'<li><span class="icon">⬆️</span><a href="../">../ (Parent Directory)</a></li>\n'
-
-            # List current directory contents
-            for item in sorted(os.listdir(dirpath)):
-                item_full_path = os.path.join(dirpath, item)
-                icon = ""
-                link_text = item
-                href_target = item
-
-                if os.path.isfile(item_full_path):
-                    icon = "📄"
-                elif os.path.isdir(item_full_path):
-                    icon = "📁"
-                    link_text = item + "/"
-                    href_target = item + "/"
-                else:
-                    icon = "❓"
-
-                # Exclude webchef.py itself and hidden files/folders (starting with '.')
-                if item == os.path.basename(__file__) or item.startswith('.'):
-                    continue
-
-                default_content += f'<li><span class="icon">{icon}</span><a href="{href_target}">{link_text}</a></li>\n'
+    # Add parent directory link if not the root directory
+    if dir_path != root_dir:
+        top += '<li><span class="icon">⬆️</span><a href="../">../ (Parent Directory)</a></li>\n'
+    return top
 
-            default_content += """
+def listing_page_bottom(listing, first, count, total, has_next):
+    """Renders the end of a listing page with its pagination links."""
+    pager = [f"Showing {first + 1}–{first + count} of {total}" if count else f"Nothing here, {total} in total"]
+    if listing.page > 1:
+        pager.append(f'<a href="{html.escape(listing_query(listing, page=listing.page - 1))}">← Previous</a>')
+    if has_next:
+        pager.append(f'<a href="{html.escape(listing_query(listing, page=listing.page + 1))}">Next →</a>')
+    return f"""
                     </ul>
+                    <p class="pager">{" · ".join(pager)}</p>
                     <p>Start cooking by adding your own <code>index.html</code>!</p>
                 </div>
             </body>
             </html>
             """
-            with open(index_path, 'w', encoding='utf-8') as f:
-                f.write(default_content)
-            _created_index_files.append(index_path)
-            print(f"Default index.html created in '{relative_dir_display}'. 😋")
+
+# --- Site Packs ---
+# Layout: header, then file bodies, gzip variants and listings, then the
+# key and meta strings, then one fixed-size record per entry sorted by key.
+# A record holds (offset, length) of its key, meta, body and gzip variant.
+PACK_MAGIC = b'WEBCHEF\x01'
+_PACK_HEADER = struct.Struct('<8sIQ')
+_PACK_RECORD = struct.Struct('<QIQIQQQQ')
+_PACK_KEY = struct.Struct('<QI')
+
+class SitePack:
+    """
+    A site pack mapped read-only. Nothing is parsed up front: a lookup is a
+    binary search over the sorted records, and bodies are memoryview slices
+    of the mapping, so the page cache holds the only copy. Responses built
+    from records are kept as templates for the most requested paths.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        if len(self.map) < _PACK_HEADER.size:
+            raise ValueError(f"{path} is not a webchef site pack")
+        magic, self.count, self.index_offset = _PACK_HEADER.unpack_from(self.map)
+        if magic != PACK_MAGIC:
+            raise ValueError(f"{path} is not a webchef site pack")
+        self.templates = functools.lru_cache(maxsize=PATH_CACHE_SIZE)(self.build_response)
+
+    def lookup(self, key):
+        """Returns the record for `key` (bytes), or None."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset, length = _PACK_KEY.unpack_from(self.map, self.index_offset + middle * _PACK_RECORD.size)
+            if self.map[offset:offset + length] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count:
+            return None
+        record = _PACK_RECORD.unpack_from(self.map, self.index_offset + low * _PACK_RECORD.size)
+        if self.map[record[0]:record[0] + record[1]] != key:
+            return None
+        return record
+
+    def response(self, path):
+        """Returns a fresh Response for a URL path, or None if the pack doesn't have it."""
+        template = self.templates(path)
+        return copy.copy(template) if template is not None else None
+
+    def build_response(self, path):
+        try:
+            record = self.lookup((path.rstrip('/') or '/').encode('utf-8', 'surrogateescape'))
+        except UnicodeEncodeError:
+            return None
+        if record is None:
+            return None
+        _, _, meta_offset, meta_length, body_offset, body_length, gzip_offset, gzip_length = record
+        kind, content_type, etag, last_modified, last_modified_date, cache_control, label = (
+            self.map[meta_offset:meta_offset + meta_length].decode('utf-8').split('\0'))
+        if kind == 'file' and path.endswith('/'):
+            return None
+
+        response = Response(200, "OK", content_type, body=self.view[body_offset:body_offset + body_length])
+        response.description += f" for {label}"
+        response.etag = etag
+        response.last_modified = int(last_modified)
+        response.headers += [('ETag', etag), ('Last-Modified', last_modified_date),
+                             ('Cache-Control', cache_control)]
+        if kind == 'listing':
+            response.headers.append(('Vary', 'Accept-Encoding'))
         else:
-            print(f"Index.html already exists in '{relative_dir_display}'. Skipping. 👍")
-
-def cleanup_generated_index_files():
-    """Deletes all index.html files that were created by webchef.py."""
-    global _created_index_files
-    if _created_index_files:
-        print("\n🗑️ Cleaning up generated index.html files...")
-        for file_path in _created_index_files:
-            try:
-                os.remove(file_path)
-                print(f"Deleted: {os.path.relpath(file_path, WEB_ROOT)}")
-            except OSError as e:
-                print(f"Error deleting {os.path.relpath(file_path, WEB_ROOT)}: {e}")
-        _created_index_files = []
-        print("Cleanup complete. ✨")
+            response.accept_ranges = True
+            response.headers.append(('Accept-Ranges', 'bytes'))
+            if is_compressible(content_type):
+                response.headers.append(('Vary', 'Accept-Encoding'))
+        if gzip_length:
+            response.gzip_body = self.view[gzip_offset:gzip_offset + gzip_length]
+        response.prefix()
+        return response
+
+site_pack = None
+
+def build_site_pack(pack_path):
+    """
+    Snapshots WEB_ROOT into a site pack at `pack_path`: every file that would
+    be served, and every directory as its index.html or default listing.
+    Hidden files are left out, as they are never served. Returns the number
+    of entries.
+    """
+    skip = {os.path.abspath(pack_path), os.path.abspath(pack_path + '.tmp')}
+    try:
+        records = []
+        with open(pack_path + '.tmp', 'wb') as out:
+            out.write(bytes(_PACK_HEADER.size))
+            for dir_path, dir_names, file_names in os.walk(WEB_ROOT):
+                dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+                relative_dir = os.path.relpath(dir_path, WEB_ROOT)
+                url_dir = '' if relative_dir == '.' else '/' + relative_dir.replace(os.sep, '/')
+                index = None
+                for name in sorted(file_names):
+                    file_path = os.path.join(dir_path, name)
+                    if name.startswith('.') or os.path.abspath(file_path) in skip:
+                        continue
+                    try:
+                        st = os.stat(file_path)
+                    except OSError:
+                        continue
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+                    entry = pack_file(out, file_path, st)
+                    records.append(pack_record(f"{url_dir}/{name}", 'file', name, *entry))
+                    if name == 'index.html':
+                        index = entry
+
+                if index is not None:
+                    records.append(pack_record(url_dir or '/', 'index', 'index.html', *index))
+                    continue
+                try:
+                    st = os.stat(dir_path)
+                except OSError:
+                    continue
+                response = Response(200, "OK", 'text/html; charset=utf-8')
+                set_validators(response, st, dir_path)
+                body = b"".join(stream_directory_listing(dir_path, DEFAULT_LISTING))
+                body_span = pack_bytes(out, body)
+                gzip_span = pack_bytes(out, pack_compress(body, len(body)))
+                records.append(pack_record(url_dir or '/', 'listing', f"listing of {relative_dir}",
+                                           response, body_span, gzip_span))
+
+            records = sorted(record for record in records if record is not None)
+            index = []
+            for key, meta, body_span, gzip_span in records:
+                index.append(_PACK_RECORD.pack(*pack_bytes(out, key), *pack_bytes(out, meta),
+                                               *body_span, *gzip_span))
+            index_offset = out.tell()
+            out.write(b"".join(index))
+            out.seek(0)
+            out.write(_PACK_HEADER.pack(PACK_MAGIC, len(index), index_offset))
+    except BaseException:
+        # Don't leave a half-written pack behind
+        try:
+            os.remove(pack_path + '.tmp')
+        except OSError:
+            pass
+        raise
+    os.replace(pack_path + '.tmp', pack_path)
+    return len(index)
+
+def pack_file(out, file_path, st):
+    """Appends a file and its gzip variant to the pack; returns (response, body span, gzip span)."""
+    response = Response(200, "OK", get_mime_type(file_path))
+    set_validators(response, st, file_path)
+    offset = out.tell()
+    with open(file_path, 'rb') as f:
+        for block in iter(functools.partial(f.read, PACK_COPY_SIZE), b''):
+            out.write(block)
+    body_span = (offset, out.tell() - offset)
+
+    gzip_span = (0, 0)
+    if body_span[1] >= COMPRESS_MIN_SIZE and is_compressible(response.content_type):
+        # A fresh .gz next to the file wins, just like when serving live
+        response.file_path = file_path
+        sidecar = open_gzip_sidecar(response)
+        if sidecar is not None:
+            with sidecar[0] as f:
+                gzip_span = pack_bytes(out, f.read())
+        else:
+            with open(file_path, 'rb') as f:
+                gzip_span = pack_bytes(out, pack_compress(f, body_span[1]))
+    return response, body_span, gzip_span
+
+def pack_compress(source, size):
+    """Gzips bytes or a file object; returns b'' if that wouldn't make it smaller."""
+    if size < COMPRESS_MIN_SIZE:
+        return b''
+    # Same settings as gzip_compress(), so the bytes match what the ETag promises
+    if isinstance(source, bytes):
+        compressed = gzip_compress(source)
     else:
-        print("No generated index.html files to clean up. 🧹")
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        parts = [compressor.compress(block)
+                 for block in iter(functools.partial(source.read, PACK_COPY_SIZE), b'')]
+        parts.append(compressor.flush())
+        compressed = b"".join(parts)
+    return compressed if len(compressed) < size else b''
 
+def pack_bytes(out, data):
+    """Appends `data` to the pack; returns its (offset, length), (0, 0) for nothing."""
+    if not data:
+        return 0, 0
+    offset = out.tell()
+    out.write(data)
+    return offset, len(data)
 
-def main():
-    """Main function to start the HTTP server."""
-    global start_time, stop_time
+def pack_record(url_path, kind, label, response, body_span, gzip_span):
+    """
+    Encodes an entry's key and metadata; None for paths no request can name.
+    Keys keep names that aren't valid UTF-8 as their raw bytes, the way
+    request paths arrive.
+    """
+    headers = dict(response.headers)
+    meta = "\0".join([kind, response.content_type, response.etag, str(response.last_modified),
+                      headers['Last-Modified'], headers['Cache-Control'], display_name(label)])
+    try:
+        return url_path.encode('utf-8', 'surrogateescape'), meta.encode('utf-8'), body_span, gzip_span
+    except UnicodeEncodeError:
+        return None
 
-    start_time = datetime.datetime.now()
+# --- Archive Downloads ---
+def archive_format(query):
+    """Returns 'zip' or 'tar' if the query asks for a directory download."""
+    if not ARCHIVE_DOWNLOADS:
+        return None
+    download = urllib.parse.parse_qs(query).get('download', [''])[-1].lower()
+    return download if download in ('zip', 'tar') else None
+
+def archive_response(dir_path, archive):
+    """Streams a directory as a zip or tar archive generated while it is sent."""
+    dir_path = os.path.normpath(dir_path)
+    top_name = display_name(os.path.basename(dir_path)) or 'webchef'
+    if archive == 'zip':
+        response = Response(200, "OK", 'application/zip')
+        response.chunks = zip_chunks(dir_path, top_name)
+    else:
+        response = Response(200, "OK", 'application/x-tar')
+        response.chunks = coalesce_chunks(tar_pieces(dir_path, top_name), ARCHIVE_CHUNK_SIZE)
+    filename = f"{top_name}.{archive}"
+    response.headers.append(('Content-Disposition', "attachment; filename=\"{}\"; filename*=UTF-8''{}".format(
+        filename.encode('ascii', 'replace').decode('ascii').replace('"', '_'), urllib.parse.quote(filename))))
+    response.headers.append(('Cache-Control', 'no-store'))
+    response.description += f" for {archive} of {display_name(os.path.relpath(dir_path, WEB_ROOT))}"
+    return response
+
+def walk_archive(dir_path, top_name):
+    """
+    Yields (path, name in the archive, stat result, is_dir) for `dir_path`
+    and every visible entry below it. Only one directory is open at a time;
+    subdirectories wait on a stack. Symlinked directories are not followed,
+    so loops and links out of the web root are left alone. Names that aren't
+    valid UTF-8 go in with U+FFFD, the same in zip and tar.
+    """
+    try:
+        pending = [(dir_path, top_name, os.stat(dir_path))]
+    except OSError:
+        return
+    while pending:
+        current, current_name, current_st = pending.pop()
+        yield current, current_name + '/', current_st, True
+        subdirectories = []
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.name == os.path.basename(__file__) or entry.name.startswith('.'):
+                        continue
+                    name = current_name + '/' + display_name(entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append((entry.path, name, entry.stat(follow_symlinks=False)))
+                        elif entry.is_file():
+                            yield entry.path, name, entry.stat(), False
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+        pending.extend(reversed(subdirectories))
+
+def is_stored_in_archive(name):
+    return os.path.splitext(name)[1].lower() in ARCHIVE_STORED_EXTENSIONS
+
+class ArchiveBuffer:
+    """Write-only stream that zipfile writes into and zip_chunks drains."""
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
 
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+def zip_chunks(dir_path, top_name):
+    """
+    Yields a zip archive of `dir_path`. zipfile writes to an unseekable
+    stream here, so sizes and CRCs follow each file in a data descriptor and
+    nothing has to be buffered beyond the current chunk.
+    """
+    buffer = ArchiveBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for path, name, st, is_dir in walk_archive(dir_path, top_name):
+            # Zip dates start in 1980
+            info = zipfile.ZipInfo(name, max(time.localtime(st.st_mtime)[:6], (1980, 1, 1, 0, 0, 0)))
+            info.external_attr = (st.st_mode & 0xFFFF) << 16
+            if is_dir:
+                info.external_attr |= 0x10
+                archive.writestr(info, b'')
+                continue
+            info.file_size = st.st_size
+            info.compress_type = zipfile.ZIP_STORED if is_stored_in_archive(name) else zipfile.ZIP_DEFLATED
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                continue
+            with f, archive.open(info, 'w') as entry:
+                while True:
+                    data = f.read(ARCHIVE_CHUNK_SIZE)
+                    if not data:
+                        break
+                    entry.write(data)
+                    if buffer.size >= ARCHIVE_CHUNK_SIZE:
+                        yield buffer.take()
+            if buffer.size >= ARCHIVE_CHUNK_SIZE:
+                yield buffer.take()
+    yield buffer.take()
+
+def tar_pieces(dir_path, top_name):
+    """
+    Yields a POSIX (pax) tar archive of `dir_path` piece by piece: a header
+    block, the file data, and padding to the next 512-byte block.
+    """
+    written = 0
+    for path, name, st, is_dir in walk_archive(dir_path, top_name):
+        info = tarfile.TarInfo(name.rstrip('/'))
+        info.mtime = int(st.st_mtime)
+        info.mode = st.st_mode & 0o7777
+        if is_dir:
+            info.type = tarfile.DIRTYPE
+            header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            written += len(header)
+            yield header
+            continue
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            continue
+        with f:
+            # The header promises a size, so that is exactly what gets sent
+            # even if the file changes underneath us
+            size = os.fstat(f.fileno()).st_size
+            info.size = size
+            header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            yield header
+            remaining = size
+            while remaining > 0:
+                data = f.read(min(ARCHIVE_CHUNK_SIZE, remaining)) or bytes(min(ARCHIVE_CHUNK_SIZE, remaining))
+                remaining -= len(data)
+                yield data
+            padding = -size % tarfile.BLOCKSIZE
+            if padding:
+                yield bytes(padding)
+            written += len(header) + size + padding
+
+    # Two empty blocks end the archive; pad to a full record like tar does
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(written + end) % tarfile.RECORDSIZE
+    yield bytes(end)
+
+def coalesce_chunks(pieces, size):
+    """Joins small pieces into chunks of at least `size` bytes."""
+    parts = []
+    total = 0
+    try:
+        for piece in pieces:
+            parts.append(piece)
+            total += len(piece)
+            if total >= size:
+                yield b"".join(parts)
+                parts = []
+                total = 0
+        if parts:
+            yield b"".join(parts)
+    finally:
+        pieces.close()
+
+def create_server_socket(reuse_port=False):
+    """Creates a TCP socket bound to HOST:PORT (not yet listening)."""
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((HOST, PORT))
+    return server_socket
 
+def parse_rate(text):
+    """Parses a bytes-per-second figure such as 500000, 512K or 2M."""
+    units = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+    text = text.strip().upper().rstrip('B')
     try:
-        server_socket.bind((HOST, PORT))
-        server_socket.listen(5)
-        print(f"✨ webchef.py is cooking! Serving on http://{HOST}:{PORT}")
-        print(f"🏡 Your kitchen (root directory): {os.path.abspath(WEB_ROOT)}")
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a byte rate: {text!r}")
 
-        # Create default index.html files in all directories that need them
-        create_all_missing_index_htmls(WEB_ROOT)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="webchef.py - a deliciously simple HTTP server for the current directory.")
+    parser.add_argument('--host', default=HOST, help=f"address to serve on (default: {HOST})")
+    parser.add_argument('--port', type=int, default=PORT, help=f"port to serve on (default: {PORT})")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default=ENGINE,
+                        help=f"serving engine (default: {ENGINE})")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help=f"number of worker processes (default: {WORKERS})")
+    parser.add_argument('--access-log', default=ACCESS_LOG if ACCESS_LOG else 'off',
+                        help="access log file, '-' for stdout or 'off' (default: %(default)s)")
+    parser.add_argument('--access-log-format', choices=['common', 'combined', 'json'],
+                        default=ACCESS_LOG_FORMAT,
+                        help=f"access log line format (default: {ACCESS_LOG_FORMAT})")
+    parser.add_argument('--access-log-sample', type=float, default=ACCESS_LOG_SAMPLE_RATE,
+                        help="share of requests to log, 0.0-1.0; errors are always logged "
+                             f"(default: {ACCESS_LOG_SAMPLE_RATE})")
+    parser.add_argument('--log-level', choices=list(LOG_LEVELS), default=LOG_LEVEL,
+                        help=f"how chatty the kitchen is; 'debug' prints every order (default: {LOG_LEVEL})")
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT_REQUESTS,
+                        help="requests per second allowed per client IP, 0 for no limit "
+                             f"(default: {RATE_LIMIT_REQUESTS})")
+    parser.add_argument('--rate-burst', type=int, default=RATE_LIMIT_BURST,
+                        help=f"requests a client may make at once before --rate-limit kicks in "
+                             f"(default: {RATE_LIMIT_BURST})")
+    parser.add_argument('--bandwidth', type=parse_rate, default=CONNECTION_BANDWIDTH,
+                        help="bytes per second per connection, e.g. 512K, 0 for no cap "
+                             f"(default: {CONNECTION_BANDWIDTH})")
+    parser.add_argument('--total-bandwidth', type=parse_rate, default=TOTAL_BANDWIDTH,
+                        help="bytes per second for all connections together, e.g. 10M, 0 for no cap "
+                             f"(default: {TOTAL_BANDWIDTH})")
+    parser.add_argument('--profile', action='store_true', default=PROFILE,
+                        help="profile a sample of requests with cProfile, time their phases and log slow ones")
+    parser.add_argument('--profile-sample', type=float, default=PROFILE_SAMPLE_RATE,
+                        help=f"share of requests to run under cProfile with --profile (default: {PROFILE_SAMPLE_RATE})")
+    parser.add_argument('--profile-output', default=PROFILE_OUTPUT,
+                        help="path prefix for the .pstats and .tracemalloc files (default: %(default)s)")
+    parser.add_argument('--slow-request', type=float, default=SLOW_REQUEST_THRESHOLD,
+                        help="with --profile, log requests slower than this many seconds "
+                             f"(default: {SLOW_REQUEST_THRESHOLD})")
+    parser.add_argument('--tracemalloc', action='store_true', default=TRACEMALLOC,
+                        help="trace memory allocations and write a snapshot at shutdown")
+    parser.add_argument('--build-pack', metavar='PACK',
+                        help="snapshot the current directory into a site pack file and exit")
+    parser.add_argument('--pack', default=SITE_PACK,
+                        help="serve from a site pack built with --build-pack instead of the directory")
+    return parser.parse_args(argv)
 
-        while True:
-            client_socket, client_address = server_socket.accept()
-            print(f"Customer arrived from {client_address[0]}:{client_address[1]} 🚶")
-            client_handler = threading.Thread(target=handle_request, args=(client_socket,))
-            client_handler.start()
+def main(argv=None):
+    """Main function to start the HTTP server."""
+    global start_time, stop_time, HOST, PORT, ENGINE, WORKERS
+    global ACCESS_LOG, ACCESS_LOG_FORMAT, ACCESS_LOG_SAMPLE_RATE, LOG_LEVEL
+    global RATE_LIMIT_REQUESTS, RATE_LIMIT_BURST, CONNECTION_BANDWIDTH, TOTAL_BANDWIDTH
+    global rate_limiter, total_bandwidth
+    global PROFILE, PROFILE_SAMPLE_RATE, PROFILE_OUTPUT, SLOW_REQUEST_THRESHOLD, TRACEMALLOC
+    global SITE_PACK, site_pack
+
+    args = parse_args(argv)
+    HOST, PORT, ENGINE, WORKERS = args.host, args.port, args.engine, max(1, args.workers)
+    ACCESS_LOG = None if args.access_log == 'off' else args.access_log
+    ACCESS_LOG_FORMAT = args.access_log_format
+    ACCESS_LOG_SAMPLE_RATE = min(1.0, max(0.0, args.access_log_sample))
+    LOG_LEVEL = args.log_level
+    RATE_LIMIT_REQUESTS, RATE_LIMIT_BURST = max(0.0, args.rate_limit), args.rate_burst
+    CONNECTION_BANDWIDTH, TOTAL_BANDWIDTH = max(0, args.bandwidth), max(0, args.total_bandwidth)
+    rate_limiter = RateLimiter(RATE_LIMIT_REQUESTS, RATE_LIMIT_BURST, RATE_LIMIT_CLIENTS)
+    total_bandwidth = Throttle(TOTAL_BANDWIDTH) if TOTAL_BANDWIDTH else None
+    PROFILE, TRACEMALLOC = args.profile, args.tracemalloc
+    PROFILE_SAMPLE_RATE = min(1.0, max(0.0, args.profile_sample))
+    PROFILE_OUTPUT, SLOW_REQUEST_THRESHOLD = args.profile_output, args.slow_request
+    SITE_PACK = args.pack
+
+    if args.build_pack:
+        started = time.perf_counter()
+        entries = build_site_pack(args.build_pack)
+        size = os.path.getsize(args.build_pack)
+        print(f"📦 Packed {entries} dishes from {os.path.abspath(WEB_ROOT)} into {args.build_pack} "
+              f"({size / (1024 * 1024):.1f} MB, {time.perf_counter() - started:.1f}s)")
+        return
+    if SITE_PACK:
+        try:
+            site_pack = SitePack(SITE_PACK)
+        except (OSError, ValueError) as e:
+            print(f"🚨 Can't open the site pack: {e}")
+            return
+    if WORKERS > 1 and not hasattr(os, 'fork'):
+        print("⚠️ --workers needs os.fork(), which this platform doesn't have. Cooking in a single process.")
+        WORKERS = 1
+    reuse_port = WORKERS > 1 and hasattr(socket, 'SO_REUSEPORT')
+
+    start_time = datetime.datetime.now()
+
+    server_socket = None
+    try:
+        server_socket = create_server_socket(reuse_port=reuse_port)
+        if not reuse_port:
+            server_socket.listen(LISTEN_BACKLOG)
+        log('info', f"✨ webchef.py is cooking! Serving on http://{HOST}:{PORT}")
+        log('info', f"🏡 Your kitchen (root directory): {os.path.abspath(WEB_ROOT)}")
+        if site_pack is not None:
+            log('info', f"📦 Serving {site_pack.count} dishes from the site pack {SITE_PACK}")
+
+        if WORKERS > 1:
+            serve_workers(server_socket, WORKERS, reuse_port)
+        else:
+            serve(server_socket)
 
     except KeyboardInterrupt:
-        print("\n🛑 Closing the kitchen for the day... 😴")
+        log('info', "\n🛑 Closing the kitchen for the day... 😴")
         stop_time = datetime.datetime.now()
     except Exception as e:
         print(f"🚨 Critical kitchen failure: {e}")
         stop_time = datetime.datetime.now()
     finally:
-        server_socket.close()
-        print("Kitchen closed. 🚪")
-        cleanup_generated_index_files()
+        if server_socket is not None:
+            server_socket.close()
+        log('info', "Kitchen closed. 🚪")
         generate_receipt()
 
 def generate_receipt():
@@ -404,7 +3353,24 @@ def generate_receipt():
     print(f"Total Uptime:       {int(hours)}h {int(minutes)}m {int(seconds)}s")
     print(f"Serving Table (Port): {PORT}")
     print(f"Kitchen Location (Root): {os.path.abspath(WEB_ROOT)}")
+    if WORKERS > 1:
+        print(f"Kitchen Stations (Workers): {WORKERS}")
     print(f"Dishes Served (Requests): {request_count}")
+    if content_cache.hits + content_cache.misses:
+        print(f"Pantry Hits (Cache): {content_cache.hits} of {content_cache.hits + content_cache.misses}")
+
+    totals = _receipt_totals if _receipt_totals is not None else receipt_vector(metrics_totals())
+    if totals[0]:
+        status_classes = totals[2:7]
+        latency = totals[7:7 + len(LATENCY_BUCKETS) + 1]
+        print("Dishes by Status:   " + "  ".join(
+            f"{i + 1}xx: {count}" for i, count in enumerate(status_classes) if count))
+        print(f"Food Delivered:     {totals[1] / (1024 * 1024):.1f} MB")
+        print("Wait Times (p50/p95/p99): " + " / ".join(
+            f"{histogram_percentile(latency, q) * 1000:.1f}" for q in (0.5, 0.95, 0.99)) + " ms")
+    reaped = dict(zip(REAPED_PHASES, totals[RECEIPT_FIELDS - len(REAPED_PHASES):]))
+    if reaped['header'] or reaped['send']:
+        print(f"Slow Customers Shown Out: {reaped['header']} ordering, {reaped['send']} eating")
     print("-" * 40)
     print("Thank you for dining with webchef.py! 🙏 Come again soon! 💖")
     print("="*40 + "\n")